@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from book_files import openBookFile
+from cleanup import strip_headers
+from cleanup.markers import TEXT_START, TEXT_END, LEGALESE_START, LEGALESE_END, get_marker_matcher
+from cleanup.text import TEXT_START_MARKERS, TEXT_END_MARKERS, LEGALESE_START_MARKERS, LEGALESE_END_MARKERS
+
+# Times finding the header/footer markers in Gutenberg texts: the compiled MarkerMatcher against
+# the startswith loops strip_headers used to run on every line, and strip_headers as a whole.
+# Example:
+# python3 benchmarks/bench_strip_headers.py gutenberg.list --limit 1000
+
+MARKER_CLASSES = ((TEXT_START, TEXT_START_MARKERS), (TEXT_END, TEXT_END_MARKERS),
+                  (LEGALESE_START, LEGALESE_START_MARKERS), (LEGALESE_END, LEGALESE_END_MARKERS))
+
+argParser = argparse.ArgumentParser("Benchmarks header/footer marker matching on Gutenberg texts")
+argParser.add_argument("texts", nargs="+", help="txt files, or list files written by 'list' (only their txt books are used)")
+argParser.add_argument("--limit", type=int, default=0, help="use at most this many texts")
+argParser.add_argument("--repeat", type=int, default=3, help="times each measurement is taken; the fastest counts")
+
+
+# The per-line matching strip_headers did before MarkerMatcher
+def matchStartswith(line):
+    flags = 0
+    for flag, markers in MARKER_CLASSES:
+        if any(line.startswith(token) for token in markers):
+            flags |= flag
+    return flags
+
+
+def getTextPaths(paths, limit):
+    textPaths = []
+    for path in paths:
+        if path.endswith(".list"):
+            with open(path, 'r') as listFile:
+                fileFormat = "txt"
+                for line in listFile:
+                    splitLine = line.split()
+                    if len(splitLine) > 2 and splitLine[1] == "FORMAT":
+                        fileFormat = splitLine[2][:-1]
+                    elif len(splitLine) == 1 and fileFormat == "txt" and splitLine[0] not in textPaths:
+                        textPaths.append(splitLine[0])
+        else:
+            textPaths.append(path)
+    return textPaths[:limit] if limit else textPaths
+
+
+def readTexts(textPaths):
+    texts = []
+    for path in textPaths:
+        with openBookFile(path) as textFile:
+            texts.append(textFile.read().decode("utf-8", "replace"))
+    return texts
+
+
+def timeBest(function, repeat):
+    best = None
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter()-startTime
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def main():
+    args = argParser.parse_args()
+    texts = readTexts(getTextPaths(args.texts, args.limit))
+    lines = [line for text in texts for line in text.splitlines()]
+    numBytes = sum(len(text) for text in texts)
+    print("Texts: "+str(len(texts))+", lines: "+str(len(lines))+", characters: "+str(numBytes))
+    matchMarkers = get_marker_matcher().match
+    naiveSeconds, naiveFlags = timeBest(lambda: [matchStartswith(line) for line in lines], args.repeat)
+    matcherSeconds, matcherFlags = timeBest(lambda: [matchMarkers(line) for line in lines], args.repeat)
+    if naiveFlags != matcherFlags:
+        print("MarkerMatcher and startswith disagree on "+str(sum(a != b for a, b in zip(naiveFlags, matcherFlags)))+" lines")
+    stripSeconds, stripped = timeBest(lambda: [strip_headers(text) for text in texts], args.repeat)
+    print("startswith loops: "+str(round(naiveSeconds, 3))+" s ("+str(round(len(lines)/naiveSeconds/1e6, 2))+"M lines/s)")
+    print("MarkerMatcher:    "+str(round(matcherSeconds, 3))+" s ("+str(round(len(lines)/matcherSeconds/1e6, 2))+"M lines/s), "
+          +str(round(naiveSeconds/matcherSeconds, 1))+"x faster")
+    print("strip_headers:    "+str(round(stripSeconds, 3))+" s ("+str(round(numBytes/stripSeconds/1e6, 1))+" MB/s)")
+
+
+if __name__ == '__main__':
+    main()
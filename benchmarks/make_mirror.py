@@ -0,0 +1,192 @@
+import os
+import sys
+import gzip
+import random
+import zipfile
+import argparse
+
+# Builds a synthetic Gutenberg mirror with the layout gutenberg_file_finder.py expects, for
+# benchmarks and for trying changes without the real mirror:
+#   - book directories in the digit tree: 0/7, 1/12, 1/3/0/8/13083
+#   - cache/generated/<N>/pg<N>.rdf for every book, and pg<N>.epub for most
+#   - txt variants: <N>-0.txt (UTF-8), <N>-8.txt (Latin-1) next to <N>.txt, <N>.txt alone,
+#     <N>-8.zip with the txt inside, and gzipped cache/generated/<N>/pg<N>.txt.utf8.gzip
+#   - books only found as epub or pdf, books only in the cache, and indices missing entirely
+#   - multi-language books, and rdf files without a language (the text's "Language:" line is used)
+# The same arguments always build the same mirror.
+# Example:
+# python3 benchmarks/make_mirror.py /tmp/gutenberg_10k --books 10000
+
+MARKER_NAME = ".synthetic_mirror" # Holds the arguments the mirror was built with
+LANGUAGES = (("en", "English"), ("en", "English"), ("en", "English"), ("en", "English"), ("fr", "French"),
+             ("de", "German"), ("fi", "Finnish"), ("nl", "Dutch"), ("it", "Italian"), ("es", "Spanish"))
+WORDS = ("the", "of", "and", "to", "a", "in", "that", "he", "was", "it", "his", "her", "with", "as",
+         "had", "for", "you", "not", "be", "on", "at", "by", "which", "have", "from", "this", "him",
+         "but", "all", "she", "they", "were", "my", "are", "me", "one", "their", "so", "an", "said",
+         "été", "déjà", "über", "señor", "naïve", "café")
+
+RDF_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:dcterms="http://purl.org/dc/terms/" xmlns:pgterms="http://www.gutenberg.org/2009/pgterms/" xmlns:dcam="http://purl.org/dc/dcam/">
+  <pgterms:ebook rdf:about="ebooks/{index}">
+    <dcterms:title>Synthetic Book {index}</dcterms:title>
+    <dcterms:creator>
+      <pgterms:agent rdf:about="2009/agents/{index}">
+        <pgterms:name>Author, Synthetic {index}</pgterms:name>
+      </pgterms:agent>
+    </dcterms:creator>
+{languages}    <dcterms:subject>
+      <rdf:Description rdf:nodeID="S{index}">
+        <dcam:memberOf rdf:resource="http://purl.org/dc/terms/LCSH"/>
+        <rdf:value>Fiction</rdf:value>
+      </rdf:Description>
+    </dcterms:subject>
+  </pgterms:ebook>
+</rdf:RDF>
+'''
+RDF_LANGUAGE_TEMPLATE = '''    <dcterms:language>
+      <rdf:Description rdf:nodeID="L{index}{languageI}">
+        <rdf:value rdf:datatype="http://purl.org/dc/terms/RFC4646">{language}</rdf:value>
+      </rdf:Description>
+    </dcterms:language>
+'''
+
+argParser = argparse.ArgumentParser("Builds a synthetic Project Gutenberg mirror")
+argParser.add_argument("mirror_dir", help="the directory to build the mirror in")
+argParser.add_argument("--books", type=int, default=1000, help="the highest book index")
+argParser.add_argument("--text-lines", type=int, default=60, help="lines of body text in each txt book")
+argParser.add_argument("--seed", type=int, default=13083, help="seed for the random choices")
+
+
+# The digit tree directory of a book, as Gutenberg.getIndexPath finds it
+def getBookDir(mirrorDir, index):
+    indexStr = str(index)
+    parts = ["0"] if index < 10 else list(indexStr[:-1])
+    return os.path.join(mirrorDir, *parts, indexStr)
+
+
+def getText(rng, index, languageNames, encodingName, textLines):
+    lines = ["The Project Gutenberg EBook of Synthetic Book "+str(index)+", by Synthetic Author",
+             "",
+             "This eBook is for the use of anyone anywhere at no cost and with",
+             "almost no restrictions whatsoever.",
+             "",
+             "Title: Synthetic Book "+str(index),
+             "",
+             "Author: Synthetic Author",
+             "",
+             "Language: "+" and ".join(languageNames),
+             "",
+             "Character set encoding: "+encodingName,
+             "",
+             "*** START OF THIS PROJECT GUTENBERG EBOOK SYNTHETIC BOOK "+str(index)+" ***",
+             "",
+             "Produced by Synthetic Volunteers",
+             ""]
+    for lineI in range(textLines):
+        lines.append(" ".join(rng.choice(WORDS) for wordI in range(rng.randint(6, 14))))
+        if lineI % 12 == 11:
+            lines.append("")
+    lines += ["",
+              "End of the Project Gutenberg EBook of Synthetic Book "+str(index),
+              "",
+              "*** END OF THIS PROJECT GUTENBERG EBOOK SYNTHETIC BOOK "+str(index)+" ***",
+              "",
+              "Updated editions will replace the previous one--the old editions",
+              "will be renamed."]
+    return "\n".join(lines)+"\n"
+
+
+def writeFile(path, data):
+    with open(path, 'wb') as newFile:
+        newFile.write(data)
+
+
+# Build the mirror and return {kind: number of books}
+def makeMirror(mirrorDir, books, textLines=60, seed=13083):
+    rng = random.Random(seed)
+    counts = {}
+    cacheDir = os.path.join(mirrorDir, "cache", "generated")
+    for index in range(1, books+1):
+        if rng.random() < 0.03:
+            counts["missing"] = counts.get("missing", 0)+1
+            continue
+        languages = [rng.choice(LANGUAGES)]
+        if rng.random() < 0.02:
+            languages.append(rng.choice([language for language in LANGUAGES if language[0] != languages[0][0]]))
+        bookCacheDir = os.path.join(cacheDir, str(index))
+        os.makedirs(bookCacheDir, exist_ok=True)
+        if rng.random() < 0.02: # Fall back to the text's "Language:" line
+            rdfLanguages = ""
+        else:
+            rdfLanguages = "".join(RDF_LANGUAGE_TEMPLATE.format(index=index, languageI=languageI, language=language[0])
+                                   for languageI, language in enumerate(languages))
+        writeFile(os.path.join(bookCacheDir, "pg"+str(index)+".rdf"),
+                  RDF_TEMPLATE.format(index=index, languages=rdfLanguages).encode("utf-8"))
+        languageNames = [language[1] for language in languages]
+        kind = rng.random()
+        if kind < 0.08:
+            kind = "cache txt"
+            text = getText(rng, index, languageNames, "UTF-8", textLines)
+            with gzip.open(os.path.join(bookCacheDir, "pg"+str(index)+".txt.utf8.gzip"), 'wb') as gzipFile:
+                gzipFile.write(text.encode("utf-8"))
+        elif kind < 0.16:
+            kind = "cache epub"
+        if kind != "cache txt" and rng.random() < 0.9:
+            writeFile(os.path.join(bookCacheDir, "pg"+str(index)+".epub"), b"PK\x03\x04 synthetic epub "+str(index).encode())
+        if isinstance(kind, str):
+            counts[kind] = counts.get(kind, 0)+1
+            continue
+        bookDir = getBookDir(mirrorDir, index)
+        os.makedirs(bookDir, exist_ok=True)
+        indexStr = str(index)
+        if kind < 0.40:
+            kind = "utf-8 txt"
+            writeFile(os.path.join(bookDir, indexStr+"-0.txt"), getText(rng, index, languageNames, "UTF-8", textLines).encode("utf-8"))
+        elif kind < 0.60:
+            kind = "latin-1 and ascii txt"
+            text = getText(rng, index, languageNames, "ISO-8859-1", textLines)
+            writeFile(os.path.join(bookDir, indexStr+"-8.txt"), text.encode("latin-1", "replace"))
+            writeFile(os.path.join(bookDir, indexStr+".txt"), text.encode("ascii", "replace"))
+        elif kind < 0.75:
+            kind = "ascii txt"
+            writeFile(os.path.join(bookDir, indexStr+".txt"), getText(rng, index, languageNames, "ASCII", textLines).encode("ascii", "replace"))
+        elif kind < 0.85:
+            kind = "zipped txt"
+            text = getText(rng, index, languageNames, "ISO-8859-1", textLines)
+            with zipfile.ZipFile(os.path.join(bookDir, indexStr+"-8.zip"), 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(indexStr+"-8.txt", text.encode("latin-1", "replace"))
+        elif kind < 0.93:
+            kind = "pdf"
+            writeFile(os.path.join(bookDir, indexStr+".pdf"), b"%PDF-1.4 synthetic "+indexStr.encode())
+        else:
+            kind = "epub"
+            writeFile(os.path.join(bookDir, indexStr+".epub"), b"PK\x03\x04 synthetic epub "+indexStr.encode())
+        if rng.random() < 0.3:
+            writeFile(os.path.join(bookDir, indexStr+"-h.zip"), b"PK\x05\x06"+b"\x00"*18) # An empty html archive
+        counts[kind] = counts.get(kind, 0)+1
+    with open(os.path.join(mirrorDir, MARKER_NAME), 'w') as markerFile:
+        markerFile.write(" ".join((str(books), str(textLines), str(seed)))+"\n")
+    return counts
+
+
+# True if mirrorDir was already built by makeMirror with the same arguments
+def isMirrorBuilt(mirrorDir, books, textLines=60, seed=13083):
+    try:
+        with open(os.path.join(mirrorDir, MARKER_NAME), 'r') as markerFile:
+            return markerFile.read().split() == [str(books), str(textLines), str(seed)]
+    except OSError:
+        return False
+
+
+def main():
+    args = argParser.parse_args()
+    if os.path.exists(args.mirror_dir) and os.listdir(args.mirror_dir):
+        print("mirror_dir needs to be empty or not exist yet: "+args.mirror_dir, file=sys.stderr)
+        exit(1)
+    counts = makeMirror(args.mirror_dir, args.books, args.text_lines, args.seed)
+    for kind, count in sorted(counts.items()):
+        print(kind+": "+str(count))
+
+
+if __name__ == '__main__':
+    main()
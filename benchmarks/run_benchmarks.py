@@ -0,0 +1,211 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from make_mirror import makeMirror, isMirrorBuilt
+from book_files import openBookFile
+from cleanup import iter_strip_headers
+
+# Times gutenberg_file_finder.py on synthetic mirrors (see make_mirror.py) and appends the results
+# to a JSON lines file, one record per mirror size and phase, so runs can be compared over time.
+# Each phase runs the script in a fresh process; its wall time, peak memory (max RSS), block I/O
+# and, when strace is installed, syscall count (from a second, traced run) are recorded:
+#   list              loadCorpus + writeList on a fresh manifest
+#   list-incremental  list --incremental with nothing changed
+#   copy              iterListFile + organizeFiles, copying every book
+#   symlink           iterListFile + organizeFiles, symlinking every book
+#   clean             strip_headers on every txt book
+#   query             query for the German epubs in the book index 'list' wrote
+#   loadList          Gutenberg.loadList on the list file, in a bare process
+# strip_headers is also timed in this process over every txt book, with tracemalloc's peak.
+# Example:
+# python3 benchmarks/run_benchmarks.py --sizes 1000,10000,100000 --jobs 4
+
+FINDER_PATH = os.path.join(REPO_DIR, "gutenberg_file_finder.py")
+DEFAULT_RESULTS_PATH = os.path.join(BENCHMARKS_DIR, "results.jsonl") # Ignored by git
+LOAD_LIST_SCRIPT = "import sys; sys.path.insert(0, sys.argv[1]); from gutenberg_file_finder import Gutenberg; Gutenberg(sys.argv[2]).loadList()"
+STRACE_TOTAL_REGEX = re.compile(r"^\s*100\.00\s+\S+\s+\S+\s+(\d+)\s+(\d+)?\s*total", re.MULTILINE)
+
+argParser = argparse.ArgumentParser("Benchmarks gutenberg_file_finder.py on synthetic mirrors")
+argParser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of books to build mirrors with")
+argParser.add_argument("--jobs", type=int, default=1, help="passed to gutenberg_file_finder.py's --jobs")
+argParser.add_argument("--phases", default="list,list-incremental,copy,symlink,clean,query,loadList,strip_headers", help="comma separated phases to run")
+argParser.add_argument("--work-dir", help="where mirrors and outputs are kept; mirrors are reused by later runs. Defaults to a temporary directory")
+argParser.add_argument("--results", default=DEFAULT_RESULTS_PATH, help="the JSON lines file results are appended to")
+argParser.add_argument("--no-syscalls", action="store_true", help="don't rerun phases under strace to count syscalls")
+
+
+def getCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+# Run command with its output discarded and return (seconds, rusage of the process)
+def runMeasured(command):
+    startTime = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+        pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter()-startTime
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError(" ".join(command)+" exited with "+str(process.returncode))
+    return seconds, usage
+
+
+# Run command under strace -c and return the total number of syscalls
+def countSyscalls(strace, command, workDir):
+    summaryPath = os.path.join(workDir, "strace.summary")
+    with open(os.devnull, 'w') as devnull:
+        subprocess.run([strace, "-f", "-c", "-o", summaryPath]+command, stdout=devnull, stderr=devnull)
+    with open(summaryPath, 'r') as summaryFile:
+        match = STRACE_TOTAL_REGEX.search(summaryFile.read())
+    return int(match.group(1)) if match else None
+
+
+# Return (command, setup) for a phase; setup, if any, prepares the work directory before each run
+def getPhaseCommand(phase, mirrorDir, outDir, jobs):
+    listPath = os.path.join(outDir, "gutenberg.list")
+    finder = [sys.executable, FINDER_PATH]
+    jobsArgs = ["--jobs", str(jobs)]
+    if phase == "list":
+        return finder+["list", mirrorDir, listPath]+jobsArgs, lambda: removePaths(os.path.join(outDir, "gutenberg_manifest.sqlite"))
+    if phase == "list-incremental":
+        return finder+["list", mirrorDir, listPath, "--incremental"]+jobsArgs, None
+    if phase in ("copy", "symlink", "clean"):
+        targetPath = os.path.join(outDir, phase)
+        return finder+[phase, listPath, targetPath]+jobsArgs, lambda: removePaths(targetPath)
+    if phase == "query":
+        return finder+["query", listPath, "--language", "de", "--format", "epub"], None
+    if phase == "loadList":
+        return [sys.executable, "-c", LOAD_LIST_SCRIPT, REPO_DIR, listPath], None
+    raise ValueError("Unknown phase: "+phase)
+
+
+def removePaths(*paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+
+
+def getListTexts(listPath):
+    paths = []
+    fileFormat = "txt"
+    with open(listPath, 'r') as listFile:
+        for line in listFile:
+            splitLine = line.split()
+            if len(splitLine) > 2 and splitLine[1] == "FORMAT":
+                fileFormat = splitLine[2][:-1]
+            elif len(splitLine) == 1 and fileFormat == "txt":
+                paths.append(splitLine[0])
+    return list(dict.fromkeys(paths))
+
+
+def stripTexts(paths):
+    numChars = 0
+    for path in paths:
+        with openBookFile(path) as textFile:
+            for line in iter_strip_headers(textFile, "utf-8"):
+                numChars += len(line)
+    return numChars
+
+
+# Clean every txt book in the list in this process; return (seconds, peak traced bytes, characters kept).
+# tracemalloc slows Python down a lot, so the peak comes from a second pass.
+def timeStripHeaders(listPath):
+    paths = getListTexts(listPath)
+    startTime = time.perf_counter()
+    numChars = stripTexts(paths)
+    seconds = time.perf_counter()-startTime
+    tracemalloc.start()
+    stripTexts(paths)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, numChars
+
+
+def getPrevious(resultsPath, books, phase):
+    previous = None
+    if os.path.isfile(resultsPath):
+        with open(resultsPath, 'r') as resultsFile:
+            for line in resultsFile:
+                record = json.loads(line)
+                if record["books"] == books and record["phase"] == phase:
+                    previous = record
+    return previous
+
+
+def main():
+    args = argParser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    phases = args.phases.split(",")
+    workDir = args.work_dir or tempfile.mkdtemp(prefix="gutenberg_bench_")
+    strace = None if args.no_syscalls else shutil.which("strace")
+    if not strace and not args.no_syscalls:
+        print("strace isn't installed, so syscalls aren't counted")
+    runInfo = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": getCommit(), "python": platform.python_version(),
+               "platform": platform.platform(), "cpus": os.cpu_count(), "jobs": args.jobs}
+    try:
+        for books in sizes:
+            mirrorDir = os.path.join(workDir, "mirror_"+str(books))
+            outDir = os.path.join(workDir, "out_"+str(books))
+            if not isMirrorBuilt(mirrorDir, books):
+                removePaths(mirrorDir)
+                print("Building a synthetic mirror with "+str(books)+" books in "+mirrorDir)
+                makeMirror(mirrorDir, books)
+            os.makedirs(outDir, exist_ok=True)
+            if "list" not in phases and not os.path.isfile(os.path.join(outDir, "gutenberg.list")):
+                phases = ["list"]+phases # Every other phase reads the list
+            for phase in phases:
+                record = dict(runInfo, books=books, phase=phase)
+                if phase == "strip_headers":
+                    seconds, peakBytes, numChars = timeStripHeaders(os.path.join(outDir, "gutenberg.list"))
+                    record.update(seconds=round(seconds, 4), peakTracedKB=peakBytes//1024, characters=numChars)
+                else:
+                    command, setup = getPhaseCommand(phase, mirrorDir, outDir, args.jobs)
+                    if setup:
+                        setup()
+                    seconds, usage = runMeasured(command)
+                    record.update(seconds=round(seconds, 4), maxRssKB=usage.ru_maxrss, blocksIn=usage.ru_inblock,
+                                  blocksOut=usage.ru_oublock, userSeconds=round(usage.ru_utime, 4), systemSeconds=round(usage.ru_stime, 4))
+                    if strace:
+                        if setup:
+                            setup()
+                        record["syscalls"] = countSyscalls(strace, command, outDir)
+                previous = getPrevious(args.results, books, phase)
+                with open(args.results, 'a') as resultsFile:
+                    resultsFile.write(json.dumps(record, sort_keys=True)+"\n")
+                line = str(books)+" books, "+phase+": "+str(record["seconds"])+" s"
+                if "maxRssKB" in record:
+                    line += ", max RSS "+str(record["maxRssKB"]//1024)+" MB"
+                if "peakTracedKB" in record:
+                    line += ", peak traced "+str(record["peakTracedKB"])+" KB"
+                if record.get("syscalls") is not None:
+                    line += ", "+str(record["syscalls"])+" syscalls"
+                if previous:
+                    line += " ("+str(round(record["seconds"]/max(previous["seconds"], 1e-9), 2))+"x the run of "+previous["date"]+" at "+previous["commit"]+")"
+                print(line)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(workDir)
+    print("Results appended to "+args.results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import os
+import re
+import errno
+import codecs
+import struct
+
+# Opens book files wherever they live. A txt file inside a per-book zip archive is addressed as
+# <archive>.zip/<member>, e.g. gutenberg/1/3/0/8/13083/13083-8.zip/13083-8.txt, and is read
+# straight from the archive without extracting it. The cache's gzipped texts (pg13083.txt.utf8.gzip)
+# are decompressed as they are read.
+# zipfile and gzip are imported when a book first needs them, to keep importing this module cheap.
+# Used by gutenberg_file_finder.py and the modules its commands hand books to.
+
+ARCHIVE_EXTENSION = ".zip"
+GZIP_EXTENSION = ".gzip"
+TEXT_SNIFF_SIZE = 1 << 13 # Bytes read to confirm a text's encoding; covers the header's "Character set encoding:" line
+ENCODING_DECLARATION_PATTERN = rb"Character set encoding:[ \t]*([\w.:-]+)" # Compiled (and cached by re) on first use
+
+
+# Return (archivePath, memberName) for a path inside a zip archive, or None for a plain file
+def splitArchivePath(path):
+    start = 0
+    while True:
+        end = path.find(ARCHIVE_EXTENSION+"/", start)
+        if end < 0:
+            return None
+        end += len(ARCHIVE_EXTENSION)
+        if os.path.isfile(path[:end]):
+            return path[:end], path[end+1:]
+        start = end
+
+
+def isArchiveMember(path):
+    return ARCHIVE_EXTENSION+"/" in path and splitArchivePath(path) is not None
+
+
+# Return the names of the txt members of a zip archive; [] if it isn't a readable zip file
+def listArchiveTexts(archivePath):
+    import zipfile
+    try:
+        with zipfile.ZipFile(archivePath) as archive:
+            return [info.filename for info in archive.infolist() if not info.is_dir() and info.filename.endswith(".txt")]
+    except (OSError, zipfile.BadZipFile):
+        return []
+
+
+# The errors reading a book file can raise: OSError, EOFError from a truncated gzip file (e.g. one a
+# sync left partly copied), and those of a corrupt archive or archive member. A function, so zipfile is
+# only imported once such an error is caught: except getBookReadErrors() as e.
+def getBookReadErrors():
+    import zlib
+    import zipfile
+    return (OSError, EOFError, zlib.error, zipfile.BadZipFile)
+
+
+# Confirm the encoding of a text from its first TEXT_SNIFF_SIZE bytes, without decoding the whole file.
+# The header's "Character set encoding:" declaration overrides expected, the suffix convention's guess; a
+# prefix that isn't valid UTF-8 can't be UTF-8 (or ASCII, which is labelled as such but often isn't).
+# Return (encoding, bytes read); expected if the text can't be read.
+def sniffTextEncoding(textPath, expected="utf-8"):
+    try:
+        with openBookFile(textPath) as textFile:
+            prefix = textFile.read(TEXT_SNIFF_SIZE)
+    except getBookReadErrors(): # Unreadable or corrupt; keep the suffix's encoding
+        return expected, 0
+    if prefix.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig", len(prefix)
+    match = re.search(ENCODING_DECLARATION_PATTERN, prefix, re.IGNORECASE)
+    if match:
+        try:
+            expected = codecs.lookup(match.group(1).decode("ascii")).name
+        except LookupError: # Something like "Unicode" or a typo; keep the suffix's guess
+            pass
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(prefix, final=False) # Tolerates a character cut off at the end
+    except UnicodeDecodeError:
+        return ("iso8859-1" if expected in ("utf-8", "ascii") else expected), len(prefix)
+    if prefix.isascii() and expected not in ("utf-8", "ascii"):
+        return expected, len(prefix)
+    return "utf-8", len(prefix) # ASCII so far, or non-ASCII that decodes as UTF-8 (which 8-bit text practically never does)
+
+
+def isCompressed(path):
+    return path.endswith(GZIP_EXTENSION)
+
+
+# Open a book file for reading bytes. Archive members and gzipped files are decompressed as
+# they are read, a buffer at a time.
+def openBookFile(path):
+    archiveMember = splitArchivePath(path) if ARCHIVE_EXTENSION+"/" in path else None
+    if archiveMember:
+        import zipfile
+        with zipfile.ZipFile(archiveMember[0]) as archive:
+            return archive.open(archiveMember[1]) # Keeps the archive's file open until the member is closed
+    if isCompressed(path):
+        import gzip
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+# Return (size, mtime in ns) of a book file. An archive member has its uncompressed size and the
+# archive's mtime; a gzipped file has the uncompressed size from its trailer (modulo 4 GB), so it
+# matches the same text uncompressed. Raises OSError if it doesn't exist.
+def statBookFile(path):
+    archiveMember = splitArchivePath(path) if ARCHIVE_EXTENSION+"/" in path else None
+    if archiveMember:
+        import zipfile
+        archivePath, memberName = archiveMember
+        try:
+            with zipfile.ZipFile(archivePath) as archive:
+                size = archive.getinfo(memberName).file_size
+        except (KeyError, zipfile.BadZipFile) as e:
+            raise OSError(errno.ENOENT, str(e), path)
+        return size, os.stat(archivePath).st_mtime_ns
+    if isCompressed(path):
+        with open(path, 'rb') as compressedFile:
+            fileStat = os.fstat(compressedFile.fileno())
+            if fileStat.st_size < 4:
+                return fileStat.st_size, fileStat.st_mtime_ns
+            compressedFile.seek(-4, os.SEEK_END)
+            return struct.unpack("<I", compressedFile.read(4))[0], fileStat.st_mtime_ns
+    fileStat = os.stat(path)
+    return fileStat.st_size, fileStat.st_mtime_ns
@@ -0,0 +1,136 @@
+import os
+import mmap
+import struct
+import bisect
+from array import array
+
+# A compact binary index of a list file written by gutenberg_file_finder.py, saved next to it as
+# <list file>.idx, so lookups like "all German epubs" or "the path of book 13083" read a few pages of
+# a memory-mapped file instead of parsing the whole list. Layout, in native byte order, with every
+# section starting at a multiple of 8 bytes:
+#   header       magic, version, byte order mark, entry, path, language and format counts, section offsets
+#   indices      int32 per entry, sorted; a book listed under several languages has an entry for each
+#   languages    uint16 per entry: the position of its language in the names
+#   formats      uint8 per entry: the position of its format in the names
+#   pathIds      uint32 per entry: the position of its path in the path offsets
+#   pathOffsets  uint64 per path, then the end of the paths
+#   names        the language names, then the format names, UTF-8 and newline separated
+#   paths        the UTF-8 paths back to back; each path is stored once
+# Used by the 'list' and 'query' commands of gutenberg_file_finder.py.
+
+BOOK_INDEX_EXTENSION = ".idx"
+MAGIC = b"GUTIDX\0\0"
+VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+HEADER = struct.Struct("=8sIIIIII7Q")
+SECTION_TYPES = ("i", "H", "B", "I", "Q") # indices, languages, formats, pathIds, pathOffsets
+
+
+def getBookIndexPath(listPath):
+    return listPath+BOOK_INDEX_EXTENSION
+
+
+def align(offset):
+    return (offset+7) & ~7
+
+
+# Write entries, (index, language, fileFormat, path) tuples, as a book index at indexPath. The file
+# is replaced in one step, so a query running at the same time sees either the old or the new index.
+def writeBookIndex(indexPath, entries):
+    languageCodes = {}
+    formatCodes = {}
+    pathIds = {}
+    rows = []
+    for index, lang, fileFormat, path in entries:
+        rows.append((index, languageCodes.setdefault(lang, len(languageCodes)),
+                     formatCodes.setdefault(fileFormat, len(formatCodes)), pathIds.setdefault(path, len(pathIds))))
+    rows.sort()
+    paths = [path.encode("utf-8") for path in pathIds] # Dicts keep insertion order, so a path's position is its id
+    pathOffsets = array("Q", [0])
+    for path in paths:
+        pathOffsets.append(pathOffsets[-1]+len(path))
+    names = "\n".join(list(languageCodes)+list(formatCodes)).encode("utf-8")
+    sections = [array("i", (row[0] for row in rows)), array("H", (row[1] for row in rows)),
+                array("B", (row[2] for row in rows)), array("I", (row[3] for row in rows)), pathOffsets]
+    offsets = []
+    offset = align(HEADER.size)
+    for section in sections:
+        offsets.append(offset)
+        offset = align(offset+len(section)*section.itemsize)
+    offsets.append(offset)
+    offsets.append(align(offset+len(names)))
+    tempPath = indexPath+".tmp"
+    with open(tempPath, 'wb') as indexFile:
+        indexFile.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER_MARK, len(rows), len(paths), len(languageCodes), len(formatCodes), *offsets))
+        for offset, data in zip(offsets, sections+[names, b"".join(paths)]):
+            indexFile.write(b"\0"*(offset-indexFile.tell()))
+            indexFile.write(data)
+    os.replace(tempPath, indexPath)
+    return len(rows)
+
+
+# A book index opened with mmap. Only the pages a query touches are read from disk.
+class BookIndex:
+    def __init__(self, indexPath):
+        with open(indexPath, 'rb') as indexFile:
+            self.map = mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.map) < HEADER.size:
+                raise ValueError("Not a book index: "+indexPath)
+            header = HEADER.unpack_from(self.map)
+            magic, version, byteOrder, numEntries, numPaths, numLanguages, numFormats = header[:7]
+            offsets = header[7:]
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a book index, or one written by another version: "+indexPath)
+            if byteOrder != BYTE_ORDER_MARK:
+                raise ValueError("Book index written on a machine with another byte order: "+indexPath)
+            view = memoryview(self.map)
+            counts = (numEntries, numEntries, numEntries, numEntries, numPaths+1)
+            self.views = [view]
+            for offset, count, typeCode in zip(offsets, counts, SECTION_TYPES):
+                self.views.append(view[offset:offset+count*struct.calcsize(typeCode)].cast(typeCode))
+            self.indices, self.languageCodes, self.formatCodes, self.pathIds, self.pathOffsets = self.views[1:]
+            names = self.map[offsets[5]:offsets[6]].rstrip(b"\0").decode("utf-8").split("\n") if numLanguages+numFormats else []
+            self.languages = names[:numLanguages]
+            self.formats = names[numLanguages:]
+            self.pathsOffset = offsets[6]
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        for view in reversed(getattr(self, "views", [])):
+            view.release()
+        self.views = []
+        self.map.close()
+
+    def getPath(self, pathId):
+        return self.map[self.pathsOffset+self.pathOffsets[pathId]:self.pathsOffset+self.pathOffsets[pathId+1]].decode("utf-8")
+
+    # Yield (index, language, fileFormat, path) for each entry with an index from minIndex to maxIndex
+    # (both included) and one of the languages and formats, in index order. None matches anything.
+    def query(self, languages=None, formats=None, minIndex=None, maxIndex=None):
+        start = 0 if minIndex is None else bisect.bisect_left(self.indices, minIndex)
+        end = len(self.indices) if maxIndex is None else bisect.bisect_right(self.indices, maxIndex)
+        languageCodes = None
+        if languages is not None:
+            languageCodes = {code for code, lang in enumerate(self.languages) if lang in languages}
+        formatCodes = None
+        if formats is not None:
+            formatCodes = {code for code, fileFormat in enumerate(self.formats) if fileFormat in formats}
+        for entryI in range(start, end):
+            if languageCodes is not None and self.languageCodes[entryI] not in languageCodes:
+                continue
+            if formatCodes is not None and self.formatCodes[entryI] not in formatCodes:
+                continue
+            yield (self.indices[entryI], self.languages[self.languageCodes[entryI]], self.formats[self.formatCodes[entryI]],
+                   self.getPath(self.pathIds[entryI]))
@@ -0,0 +1,47 @@
+import os
+import time
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from book_files import getBookReadErrors, openBookFile, sniffTextEncoding
+from cleanup import write_stripped
+
+# Strips the Gutenberg headers and footers from books in a pool of processes.
+# Used by the 'clean' command of gutenberg_file_finder.py.
+
+CLEAN_ERRORS = getBookReadErrors()+(LookupError,)
+
+
+# Worker: clean sourcePath into the first of targetPaths as UTF-8 and copy the result to the rest. An
+# encoding that isn't confirmed is only the guess from the file's name, and is confirmed from the text's
+# first bytes first. Return (sourcePath, seconds, lines written, error message).
+def cleanBook(task):
+    sourcePath, encoding, confirmed, targetPaths = task
+    startTime = time.perf_counter()
+    numLines = 0
+    if not confirmed:
+        encoding = sniffTextEncoding(sourcePath, encoding)[0]
+    try:
+        with openBookFile(sourcePath) as source, open(targetPaths[0], 'w', encoding="utf-8") as target:
+            numLines = write_stripped(source, target, encoding)
+        for targetPath in targetPaths[1:]: # Listed under several languages
+            shutil.copyfile(targetPaths[0], targetPath)
+    except CLEAN_ERRORS as e:
+        for targetPath in targetPaths:
+            if os.path.isfile(targetPath): # Don't leave a partial book behind
+                os.unlink(targetPath)
+        return sourcePath, time.perf_counter()-startTime, 0, str(e) or type(e).__name__
+    return sourcePath, time.perf_counter()-startTime, numLines, ""
+
+
+# Yield cleanBook's result for each (sourcePath, encoding, confirmed, targetPaths) task, in order. With jobs > 1
+# the tasks are handed to a pool of jobs processes in chunks, so small books don't cost a round trip each.
+def cleanBooks(tasks, jobs=1):
+    if jobs > 1:
+        chunksize = max(1, min(64, len(tasks)//(jobs*8)))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for result in executor.map(cleanBook, tasks, chunksize=chunksize):
+                yield result
+    else:
+        for task in tasks:
+            yield cleanBook(task)
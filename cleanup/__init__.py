@@ -2,4 +2,6 @@
 # https://github.com/c-w/gutenberg
 
 
+from cleanup.strip_headers import iter_strip_headers  # noqa
 from cleanup.strip_headers import strip_headers  # noqa
+from cleanup.strip_headers import write_stripped  # noqa
@@ -0,0 +1,74 @@
+"""Module to find which Project Gutenberg header/footer markers a line starts
+with, in a single call."""
+
+from __future__ import absolute_import, unicode_literals
+import re
+
+TEXT_START = 1
+TEXT_END = 2
+LEGALESE_START = 4
+LEGALESE_END = 8
+
+
+class MarkerMatcher(object):
+    """Matches line prefixes against several classes of markers at once.
+    All markers are compiled into one regex alternation anchored at the start
+    of the line, longest first. Since every marker a line starts with is a
+    prefix of the longest one it starts with, the classes of all the markers
+    that are prefixes of a marker are stored with it, and one match gives
+    every class the line hits.
+    Args:
+        marker_classes (dict): Maps a class flag to its marker strings.
+    """
+
+    def __init__(self, marker_classes):
+        flags = {}
+        for flag, markers in marker_classes.items():
+            for marker in markers:
+                flags[marker] = flags.get(marker, 0) | flag
+        self._flags = {}
+        for marker in flags:
+            self._flags[marker] = 0
+            for other, flag in flags.items():
+                if marker.startswith(other):
+                    self._flags[marker] |= flag
+        alternation = '|'.join(re.escape(marker) for marker in
+                               sorted(flags, key=lambda marker: (-len(marker), marker)))
+        self._match = re.compile(alternation).match
+
+    def match(self, line):
+        """Return the flags of the marker classes the line starts with.
+        Args:
+            line (unicode): A line of text.
+        Returns:
+            int: The classes' flags or'ed together; 0 if the line starts with
+            no marker.
+        """
+        found = self._match(line)
+        return self._flags[found.group()] if found else 0
+
+
+_gutenberg_matcher = None
+
+
+def get_marker_matcher():
+    """Return the MarkerMatcher for the markers in cleanup.text, compiled on
+    first use. The marker sets are only imported then, so importing cleanup
+    stays cheap.
+    Returns:
+        MarkerMatcher: Matches TEXT_START, TEXT_END, LEGALESE_START and
+        LEGALESE_END.
+    """
+    global _gutenberg_matcher
+    if _gutenberg_matcher is None:
+        from cleanup.text import TEXT_END_MARKERS
+        from cleanup.text import TEXT_START_MARKERS
+        from cleanup.text import LEGALESE_END_MARKERS
+        from cleanup.text import LEGALESE_START_MARKERS
+        _gutenberg_matcher = MarkerMatcher({
+            TEXT_START: TEXT_START_MARKERS,
+            TEXT_END: TEXT_END_MARKERS,
+            LEGALESE_START: LEGALESE_START_MARKERS,
+            LEGALESE_END: LEGALESE_END_MARKERS,
+        })
+    return _gutenberg_matcher
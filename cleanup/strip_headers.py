@@ -5,36 +5,57 @@ from __future__ import absolute_import, unicode_literals
 from builtins import str
 import os
 
-from cleanup.text import TEXT_END_MARKERS
-from cleanup.text import TEXT_START_MARKERS
-from cleanup.text import LEGALESE_END_MARKERS
-from cleanup.text import LEGALESE_START_MARKERS
+from cleanup.markers import TEXT_END
+from cleanup.markers import TEXT_START
+from cleanup.markers import LEGALESE_END
+from cleanup.markers import LEGALESE_START
+from cleanup.markers import get_marker_matcher
 
 
-def strip_headers(text):
-    """Remove lines that are part of the Project Gutenberg header or footer.
-    Note: this function is a port of the C++ utility by Johannes Krugel. The
-    original version of the code can be found at:
-    http://www14.in.tum.de/spp1307/src/strip_headers.cpp
+HEADER_LINES = 600
+"""int: Number of output lines within which a start marker may still end the
+header. Only this many lines are ever buffered."""
+
+
+def _split_lines(lines, encoding, errors):
+    """Yield the individual lines of an iterable of text or byte lines."""
+    for chunk in lines:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode(encoding, errors)
+        # Split like str.splitlines() does on the whole text; an empty item is a blank line
+        for line in chunk.splitlines() or [chunk]:
+            yield line
+
+
+def iter_strip_headers(lines, encoding='utf-8', errors='replace'):
+    """Yield the lines of a text that are not part of the Project Gutenberg
+    header or footer, without reading the whole text into memory.
+    Lines are kept back only until HEADER_LINES lines have been output, since
+    until then a start marker can discard everything before it.
     Args:
-        text (unicode): The body of the text to clean up.
-    Returns:
-        unicode: The text with any non-text content removed.
+        lines (iterable): The text's lines, e.g. a text or binary file object
+            or a list of strings. Byte lines are decoded with encoding.
+        encoding (str): The codec used to decode byte lines.
+        errors (str): How undecodable bytes are handled, as in bytes.decode.
+    Yields:
+        unicode: The text's lines, without line separators, with any non-text
+        content removed.
     """
-    lines = text.splitlines()
     sep = str(os.linesep)
+    match_markers = get_marker_matcher().match
 
-    out = []
+    out = []  # None once no start marker can discard the output anymore
     i = 0
     footer_found = False
     ignore_section = False
 
-    for line in lines:
+    for line in _split_lines(lines, encoding, errors):
         reset = False
+        markers = match_markers(line)
 
-        if i <= 600:
+        if i <= HEADER_LINES:
             # Check if the header ends here
-            if any(line.startswith(token) for token in TEXT_START_MARKERS):
+            if markers & TEXT_START:
                 reset = True
 
             # If it's the end of the header, delete the output produced so far.
@@ -46,48 +67,92 @@ def strip_headers(text):
 
         if i >= 100:
             # Check if the footer begins here
-            if any(line.startswith(token) for token in TEXT_END_MARKERS):
+            if markers & TEXT_END:
                 footer_found = True
 
             # If it's the beginning of the footer, stop output
             if footer_found:
                 break
 
-        if any(line.startswith(token) for token in LEGALESE_START_MARKERS):
+        if markers & LEGALESE_START:
             ignore_section = True
             continue
-        elif any(line.startswith(token) for token in LEGALESE_END_MARKERS):
+        elif markers & LEGALESE_END:
             ignore_section = False
             continue
 
         if not ignore_section:
-            out.append(line.rstrip(sep))
+            line = line.rstrip(sep)
             i += 1
+            if out is None:
+                yield line
+                continue
+            out.append(line)
+            if i > HEADER_LINES:
+                # Past the header: release the lookback buffer and stream
+                for kept_line in out:
+                    yield kept_line
+                out = None
+
+    if out:
+        for kept_line in out:
+            yield kept_line
+
+
+def strip_headers(text):
+    """Remove lines that are part of the Project Gutenberg header or footer.
+    Note: this function is a port of the C++ utility by Johannes Krugel. The
+    original version of the code can be found at:
+    http://www14.in.tum.de/spp1307/src/strip_headers.cpp
+    Args:
+        text (unicode): The body of the text to clean up.
+    Returns:
+        unicode: The text with any non-text content removed.
+    """
+    return str(os.linesep).join(iter_strip_headers(text.splitlines()))
 
-    return sep.join(out)
+
+def write_stripped(infile, outfile, encoding='utf-8', errors='replace'):
+    """Write a text without its Project Gutenberg header and footer, a line
+    at a time, so neither the text nor the result is held in memory.
+    Args:
+        infile (file): The text, opened in binary or text mode.
+        outfile (file): A text file the lines are written to, separated as in
+            the result of strip_headers.
+        encoding (str): The codec used to decode infile if it is binary.
+        errors (str): How undecodable bytes are handled, as in bytes.decode.
+    Returns:
+        int: The number of lines written.
+    """
+    sep = str(os.linesep)
+    num_lines = 0
+    for line in iter_strip_headers(infile, encoding, errors):
+        if num_lines:
+            outfile.write(sep)
+        outfile.write(line)
+        num_lines += 1
+    return num_lines
 
 
 def _main():
     """Command line interface to the module.
     """
-    from argparse import ArgumentParser, FileType
-    from gutenberg import Error
-    from gutenberg._util.os import reopen_encoded
+    from argparse import ArgumentParser
+    import io
 
     parser = ArgumentParser(description='Remove headers and footers from a '
                                         'Project Gutenberg text')
-    parser.add_argument('infile', type=FileType('r'))
-    parser.add_argument('outfile', type=FileType('w'))
+    parser.add_argument('infile')
+    parser.add_argument('outfile')
+    parser.add_argument('--encoding', default='utf-8',
+                        help='the encoding of infile; outfile is UTF-8')
     args = parser.parse_args()
 
     try:
-        with reopen_encoded(args.infile, 'r', 'utf8') as infile:
-            text = infile.read()
-            clean_text = strip_headers(text)
-
-        with reopen_encoded(args.outfile, 'w', 'utf8') as outfile:
-            outfile.write(clean_text)
-    except Error as error:
+        with io.open(args.infile, 'rb') as infile, \
+                io.open(args.outfile, 'w', encoding='utf-8') as outfile:
+            write_stripped(infile, outfile, args.encoding)
+    except (IOError, LookupError) as error:
         parser.error(str(error))
 
 
@@ -0,0 +1,252 @@
+import codecs
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from book_files import openBookFile, sniffTextEncoding, statBookFile
+from clean_books import CLEAN_ERRORS
+
+# Counts the bytes, lines, tokens and characters of books per language and format, with the
+# distribution of book lengths. Files are read in STATS_CHUNK_SIZE chunks and each chunk is counted
+# with numpy over its bytes: lines are newline bytes, tokens are runs of non-whitespace bytes and
+# UTF-8 characters are the bytes that don't continue a multi-byte sequence. Books are split into
+# groups, each group is counted by one worker process into partial aggregates, and the parent merges them.
+# Used by the 'stats' command of gutenberg_file_finder.py.
+
+STATS_CHUNK_SIZE = 1 << 20
+BUCKETS_PER_DOUBLING = 4 # Resolution of the length histograms: bucket bounds grow by 2^(1/4), about 19%
+NUM_LENGTH_BUCKETS = 64*BUCKETS_PER_DOUBLING
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+GROUPS_PER_JOB = 4 # Groups of books per worker process, so one slow group doesn't leave the others idle
+COUNT_FIELDS = ("bytes", "lines", "tokens", "characters")
+SPACE_BYTES = np.zeros(256, dtype=bool)
+SPACE_BYTES[list(b" \t\n\r\x0b\x0c")] = True
+SINGLE_BYTE_CODEC_PREFIXES = ("ascii", "latin", "iso8859", "cp125", "koi8", "mac-")
+
+
+def getLengthBucket(length):
+    return min(int(BUCKETS_PER_DOUBLING*np.log2(length+1)), NUM_LENGTH_BUCKETS-1)
+
+
+# The smallest length in a bucket of the length histograms
+def getBucketBound(bucket):
+    return int(round(2**(bucket/BUCKETS_PER_DOUBLING)))-1
+
+
+# Sums and length histograms of a set of books, mergeable with those of other workers
+class Aggregate:
+    def __init__(self):
+        self.books = 0
+        self.failed = 0
+        self.sums = np.zeros(len(COUNT_FIELDS), dtype=np.int64)
+        self.byteLengths = np.zeros(NUM_LENGTH_BUCKETS, dtype=np.int64)
+        self.tokenLengths = np.zeros(NUM_LENGTH_BUCKETS, dtype=np.int64) # Only of txt books
+        self.minima = np.full(2, -1, dtype=np.int64) # Shortest and longest book in bytes and tokens; -1 if none
+        self.maxima = np.full(2, -1, dtype=np.int64)
+
+    def add(self, counts, isText):
+        self.books += 1
+        self.sums += counts
+        self.byteLengths[getLengthBucket(counts[0])] += 1
+        lengths = [counts[0], counts[2] if isText else -1]
+        if isText:
+            self.tokenLengths[getLengthBucket(counts[2])] += 1
+        for lengthI, length in enumerate(lengths):
+            if length >= 0:
+                self.minima[lengthI] = length if self.minima[lengthI] < 0 else min(self.minima[lengthI], length)
+                self.maxima[lengthI] = max(self.maxima[lengthI], length)
+
+    def merge(self, other):
+        self.books += other.books
+        self.failed += other.failed
+        self.sums += other.sums
+        self.byteLengths += other.byteLengths
+        self.tokenLengths += other.tokenLengths
+        for lengthI in range(2):
+            if other.minima[lengthI] >= 0:
+                self.minima[lengthI] = other.minima[lengthI] if self.minima[lengthI] < 0 else min(self.minima[lengthI], other.minima[lengthI])
+            self.maxima[lengthI] = max(self.maxima[lengthI], other.maxima[lengthI])
+
+    # The distribution of lengths in a histogram: exact minimum and maximum, percentiles (the largest length
+    # of the bucket they fall in, capped at the maximum) and the non-empty buckets as [from, to, books],
+    # from and to included
+    def getDistribution(self, histogram, lengthI):
+        total = int(histogram.sum())
+        if not total:
+            return None
+        cumulative = np.cumsum(histogram)
+        maximum = int(self.maxima[lengthI])
+        percentiles = {}
+        for percentile in PERCENTILES:
+            bucket = int(np.searchsorted(cumulative, total*percentile/100.0))
+            percentiles["p"+str(percentile)] = min(getBucketBound(bucket+1)-1, maximum)
+        buckets = [[getBucketBound(bucket), getBucketBound(bucket+1)-1, int(histogram[bucket])] for bucket in np.flatnonzero(histogram)]
+        return {"min": int(self.minima[lengthI]), "max": maximum, "percentiles": percentiles, "histogram": buckets}
+
+    def asDict(self):
+        result = {"books": self.books, "failed": self.failed}
+        for field, value in zip(COUNT_FIELDS, self.sums):
+            result[field] = int(value)
+        result["byteLengths"] = self.getDistribution(self.byteLengths, 0)
+        result["tokenLengths"] = self.getDistribution(self.tokenLengths, 1)
+        return result
+
+
+# Return "utf-8", "utf-8-sig" (UTF-8 after a byte order mark), "single" (one byte per character) or "decode"
+# for a Python codec name
+def getCountMode(encoding):
+    name = codecs.lookup(encoding).name
+    if name in ("utf-8", "utf-8-sig"):
+        return name
+    if name.startswith(SINGLE_BYTE_CODEC_PREFIXES):
+        return "single"
+    return "decode"
+
+
+# Return [bytes, lines, tokens, characters] of a text given as byte chunks. characters is only counted for
+# UTF-8 chunks, or else taken to be the number of bytes. A last line without a newline is counted.
+def countChunks(chunks, isUTF8):
+    counts = [0, 0, 0, 0]
+    previousSpace = True
+    lastByte = 10
+    for chunk in chunks:
+        if not chunk:
+            continue
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        space = SPACE_BYTES[data]
+        counts[0] += len(data)
+        counts[1] += int(np.count_nonzero(data == 10))
+        counts[2] += int(np.count_nonzero(space[:-1] & ~space[1:]))+int(previousSpace and not space[0])
+        counts[3] += int(np.count_nonzero((data & 0xC0) != 0x80)) if isUTF8 else len(data)
+        previousSpace = bool(space[-1])
+        lastByte = int(data[-1])
+    if lastByte != 10:
+        counts[1] += 1
+    return counts
+
+
+def iterFileChunks(textFile):
+    while True:
+        chunk = textFile.read(STATS_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+# Pass chunks through, adding up their bytes in numBytes[0]
+def iterCountedChunks(chunks, numBytes):
+    for chunk in chunks:
+        numBytes[0] += len(chunk)
+        yield chunk
+
+
+# Pass chunks through without the byte order mark at the start of the first one
+def iterChunksWithoutBOM(chunks):
+    isFirst = True
+    for chunk in chunks:
+        if isFirst and chunk.startswith(codecs.BOM_UTF8):
+            chunk = chunk[len(codecs.BOM_UTF8):]
+        isFirst = False
+        yield chunk
+
+
+# Yield a text decoded with encoding and re-encoded as UTF-8, a chunk at a time
+def iterRecodedChunks(chunks, encoding):
+    decoder = codecs.getincrementaldecoder(encoding)("replace")
+    for chunk in chunks:
+        yield decoder.decode(chunk).encode("utf-8")
+    yield decoder.decode(b"", final=True).encode("utf-8")
+
+
+# Yield the lines iter_strip_headers keeps as UTF-8 chunks of about STATS_CHUNK_SIZE bytes, separated by
+# newlines as write_stripped writes them for 'clean'
+def iterStrippedChunks(textFile, encoding):
+    from cleanup import iter_strip_headers
+    lines = []
+    numChars = 0
+    separator = ""
+    for line in iter_strip_headers(textFile, encoding):
+        lines.append(line)
+        numChars += len(line)+1
+        if numChars >= STATS_CHUNK_SIZE:
+            yield (separator+"\n".join(lines)).encode("utf-8")
+            lines = []
+            numChars = 0
+            separator = "\n"
+    if lines:
+        yield (separator+"\n".join(lines)).encode("utf-8")
+
+
+# Return [bytes, lines, tokens, characters] of a txt book. With stripHeaders only the lines strip_headers
+# keeps are counted, as UTF-8; otherwise bytes are the file's own, and the rest is counted from its chunks
+# as they are read: without a UTF-8 byte order mark, and recoded to UTF-8 for multi-byte encodings other
+# than UTF-8. Only a chunk at a time is held in memory either way.
+def countText(path, encoding, stripHeaders):
+    with openBookFile(path) as textFile:
+        if stripHeaders:
+            return countChunks(iterStrippedChunks(textFile, encoding), True)
+        mode = getCountMode(encoding)
+        numBytes = [0]
+        chunks = iterCountedChunks(iterFileChunks(textFile), numBytes)
+        if mode == "utf-8-sig":
+            chunks = iterChunksWithoutBOM(chunks)
+        elif mode == "decode":
+            chunks = iterRecodedChunks(chunks, encoding)
+        counts = countChunks(chunks, mode != "single")
+        counts[0] = numBytes[0]
+        return counts
+
+
+# Worker: count a group of (path, encoding, confirmed, fileFormat, keys) tasks. Return ({key: Aggregate},
+# [(path, error)]). txt books are counted in full, with an encoding that isn't confirmed (only the guess from
+# the file's name) confirmed from the text's first bytes first; the other formats only have their size.
+def countBooks(tasks, stripHeaders=False):
+    aggregates = {}
+    failures = []
+    for path, encoding, confirmed, fileFormat, keys in tasks:
+        isText = fileFormat == "txt"
+        try:
+            if isText:
+                if not confirmed:
+                    encoding = sniffTextEncoding(path, encoding)[0]
+                counts = np.array(countText(path, encoding, stripHeaders), dtype=np.int64)
+            else:
+                counts = np.array([statBookFile(path)[0], 0, 0, 0], dtype=np.int64)
+        except CLEAN_ERRORS as e:
+            failures.append((path, str(e) or type(e).__name__))
+            counts = None
+        for key in keys:
+            if key not in aggregates:
+                aggregates[key] = Aggregate()
+            if counts is None:
+                aggregates[key].failed += 1
+            else:
+                aggregates[key].add(counts, isText)
+    return aggregates, failures
+
+
+def countGroup(group):
+    tasks, stripHeaders = group
+    return countBooks(tasks, stripHeaders)
+
+
+# Count the tasks in jobs processes (each counts whole groups of books) and merge their partial aggregates.
+# Return ({key: Aggregate}, [(path, error)]).
+def computeStats(tasks, jobs=1, stripHeaders=False):
+    if jobs > 1:
+        numGroups = min(len(tasks), jobs*GROUPS_PER_JOB) or 1
+        groups = [(tasks[groupI::numGroups], stripHeaders) for groupI in range(numGroups)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            partials = list(executor.map(countGroup, groups))
+    else:
+        partials = [countBooks(tasks, stripHeaders)]
+    aggregates = {}
+    failures = []
+    for partialAggregates, partialFailures in partials:
+        for key, aggregate in partialAggregates.items():
+            if key in aggregates:
+                aggregates[key].merge(aggregate)
+            else:
+                aggregates[key] = aggregate
+        failures += partialFailures
+    return aggregates, sorted(failures)
@@ -1,9 +1,21 @@
 import os
 import re
+import io
 import argparse
 import sys
 import shutil
 import ntpath
+import errno
+import time
+import threading
+import functools
+from array import array
+from collections import namedtuple
+from itertools import repeat
+
+from book_index import BookIndex, getBookIndexPath, writeBookIndex, BOOK_INDEX_EXTENSION
+from book_files import (ARCHIVE_EXTENSION, GZIP_EXTENSION, getBookReadErrors, isArchiveMember, isCompressed, listArchiveTexts, openBookFile,
+                        sniffTextEncoding, statBookFile)
 
 # USAGE: python3 gutenberg_file_finder.py <command> <file-type> <gutenberg-dir> <target-path>
 # Commands: ls mv cp
@@ -16,35 +28,118 @@ file_type = ""
 gutenberg_dir = ""
 target_path = ""
 
+MANIFEST_NAME = "gutenberg_manifest.sqlite"
+LIST_BUFFER_SIZE = 1 << 20
+FILE_OUTPUT_COMMANDS = ("list", "dedup-near", "query", "merge", "stats")
+SCAN_COMMANDS = ("list", "merge") # gutenberg_dir has to be the Gutenberg directory
+SHARD_SUFFIX = ".shard-{}-of-{}.sqlite" # Partial result of 'list --shard K/N', next to the list file
+SHARD_REGEX = re.compile(r"\.shard-(\d+)-of-(\d+)\.sqlite$")
+COPY_BUFFER_SIZE = 1 << 20
+HASH_CHUNK_SIZE = 1 << 20
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+PROGRESS_INTERVAL = 5000
+PLACE_COMMANDS = ("move", "copy", "link", "symlink", "reflink")
+LINK_COMMANDS = ("link", "symlink")
+PLACE_TEST_NAME = ".gutenberg_place_test"
+JOURNAL_NAME = ".gutenberg_organize.journal"
+CLEAN_REPORT_NAME = "gutenberg_clean_report.tsv"
+SLOWEST_BOOKS_SHOWN = 5
+FICLONE = 0x40049409 # From linux/fs.h
+# Gutenberg's txt naming convention, best first: 13083-0.txt is UTF-8, 13083-8.txt 8-bit (mostly Latin-1), 13083.txt ASCII.
+# The cache has pg13083.txt.utf8, or gzipped pg13083.txt.utf8.gzip.
+TXT_VARIANTS = (("-0.txt", "utf-8"), (".txt.utf8", "utf-8"), (".txt.utf8"+GZIP_EXTENSION, "utf-8"), ("-8.txt", "iso8859-1"), (".txt", "ascii"))
+CACHE_TEXT_EXTENSIONS = (".txt.utf8", ".txt.utf8"+GZIP_EXTENSION)
+
+
+# A regex compiled the first time it's used, so importing this module stays cheap
+class LazyRegex:
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name): # Only called until the compiled regex's methods are copied onto self
+        regex = re.compile(self.pattern, self.flags)
+        for method in ("match", "search", "findall", "finditer", "split", "sub"):
+            setattr(self, method, getattr(regex, method))
+        return getattr(regex, name)
+
+
 argParser = argparse.ArgumentParser("Finds text files in the project Gutenberg corpus by language")
-argParser.add_argument("command", choices=['list','move','copy'], help="enter 'list' to list the proposed file organization; enter 'move' to move files into organized directories; enter 'copy' to copy files instead")
-argParser.add_argument("gutenberg_dir", help="the directory where project gutenberg files are found. e.g. gutenberg.readingroo.ms/gutenberg. If a file (from 'list') is entered instead of a directory, the file is used instead of searching the gutenberg directories")
-argParser.add_argument("target_path", help="the directory where the files are placed; if 'list' is chosen, the name of the file to write the listed files")
-args = argParser.parse_args()
+argParser.add_argument("command", choices=['list','move','copy','link','symlink','reflink','dedup-near','clean','query','merge','stats'], help="enter 'list' to list the proposed file organization; enter 'move' to move files into organized directories; enter 'copy' to copy files instead; enter 'link', 'symlink' or 'reflink' to hard link, symlink or reflink (copy-on-write clone) them without copying any data. 'link' makes symlinks across devices, 'reflink' copies across devices; enter 'dedup-near' to write clusters of near-duplicate txt books (e.g. re-releases and transcodings) to target_path (requires numpy); enter 'clean' to write the txt books without their Gutenberg headers and footers into organized directories; enter 'query' to print the paths of the books in a list file with the --language, --format and --indices given, read from the binary index 'list' writes next to the list file; enter 'merge' to combine the partial results of 'list --shard' runs into the list file target_path; enter 'stats' to write the bytes, lines, tokens and characters of the books, and the distribution of their lengths, per language and format to the JSON file target_path (requires numpy)")
+argParser.add_argument("gutenberg_dir", help="the directory where project gutenberg files are found. e.g. gutenberg.readingroo.ms/gutenberg. If a file (from 'list') is entered instead of a directory, the file is used instead of searching the gutenberg directories; for 'stats', a scan manifest ("+MANIFEST_NAME+" or a shard's partial result) can be entered too")
+argParser.add_argument("target_path", nargs="?", help="the directory where the files are placed; if 'list', 'dedup-near' or 'stats' is chosen, the name of the file to write the listed files or the report to; for 'query', the file to write the paths to (default: standard output)")
+argParser.add_argument("--incremental", action="store_true", help="for 'list', only rescan book directories that are new or whose directory or rdf file changed since the last scan, as recorded in "+MANIFEST_NAME+" next to the list file")
+argParser.add_argument("--shard", help="for 'list', K/N: only scan the books whose index modulo N is K (0 to N-1), and write a partial result to <target_path>"+SHARD_SUFFIX.format("K", "N")+" instead of the list. 'merge' combines the N partial results")
+argParser.add_argument("--catalog", help="for 'list', the consolidated rdf catalog (rdf-files.tar.bz2) to read book languages from in one pass, instead of opening each book's rdf file")
+argParser.add_argument("--dedup", action="store_true", help="for 'list' or 'merge', only list one book per unique file content, and write the books left out to <target_path>.duplicates")
+argParser.add_argument("--identify-languages", action="store_true", help="for 'list' or 'merge', identify the language of each txt book from its text, with character trigram profiles trained on the books whose language is known (requires numpy). Books without a language get the identified one, and labels the text disagrees with are written to <target_path>.languages")
+argParser.add_argument("--verify", action="store_true", help="when rerunning move, copy or a link command, only skip files recorded as placed in the target's journal if their size and modification time still match")
+argParser.add_argument("--keep-compressed", action="store_true", help="for 'copy', copy the cache's gzipped texts (pg<N>.txt.utf8.gzip) as they are, instead of decompressing them into the target")
+argParser.add_argument("--threshold", type=float, default=0.8, help="for 'dedup-near', the estimated share of word 5-grams two books must have in common to be reported as near duplicates")
+argParser.add_argument("--strip-headers", action="store_true", help="for 'stats', count the txt books without their Gutenberg headers and footers, as 'clean' writes them")
+argParser.add_argument("--language", help="for 'query', comma separated languages as named in the list file (e.g. de,fr)")
+argParser.add_argument("--format", help="for 'query', comma separated file formats (e.g. txt,epub)")
+argParser.add_argument("--indices", help="for 'query', a book index (13083) or an index range (100-200, 100- or -200; write --indices=-200)")
+argParser.add_argument("--report", help="write the time, calls, bytes and filesystem calls of each phase, and the corpus statistics, to this JSON file")
+argParser.add_argument("--profile", help="run the command under cProfile and write its stats to this file (read it with python3 -m pstats)")
+argParser.add_argument("--jobs", type=int, default=1, help="number of threads used to scan book directories and read language metadata, or to copy and move files, or processes used to compute signatures for 'dedup-near', to clean books or to count them for 'stats'; the output is the same as with a single thread")
 
 
 def eprint(text):
     print(text, file=sys.stderr)
 
 
-if not os.path.isdir(args.gutenberg_dir):
-    if args.command == 'list':
-        eprint("gutenberg_dir needs to be a directory for the list command")
-        exit()
-    elif not os.path.isfile(args.gutenberg_dir):
-        eprint("Couldn't find gutenberg_dir: "+args.gutenberg_dir)
-        exit()
-
-if os.path.isfile(args.target_path):
-    if args.command != 'list':
-        eprint("target_path needs to be a directory for the "+args.command+" command")
-        exit()
-elif args.command == 'list':
-    eprint("target_path needs to be a file (not a directory) for the 'list' command")
-    exit()
+# Print what's wrong with the command line arguments and return False, or return True
+def checkArgs(args):
+    if not os.path.isdir(args.gutenberg_dir):
+        if args.command in SCAN_COMMANDS:
+            eprint("gutenberg_dir needs to be a directory for the "+args.command+" command")
+            return False
+        elif not os.path.isfile(args.gutenberg_dir):
+            eprint("Couldn't find gutenberg_dir: "+args.gutenberg_dir)
+            return False
+    elif args.command == 'query':
+        eprint("gutenberg_dir needs to be a list file (or its "+BOOK_INDEX_EXTENSION+" index) for the query command")
+        return False
+    if args.target_path is None:
+        if args.command != 'query':
+            eprint("target_path is needed for the '"+args.command+"' command")
+            return False
+    elif os.path.isfile(args.target_path):
+        if args.command not in FILE_OUTPUT_COMMANDS:
+            eprint("target_path needs to be a directory for the "+args.command+" command")
+            return False
+    elif args.command in FILE_OUTPUT_COMMANDS and os.path.isdir(args.target_path):
+        eprint("target_path needs to be a file (not a directory) for the '"+args.command+"' command")
+        return False
+    if not 0 < args.threshold <= 1:
+        eprint("--threshold needs to be more than 0 and at most 1")
+        return False
+    if args.shard and args.command != 'list':
+        eprint("--shard is only used by the list command")
+        return False
+    if args.shard and (args.dedup or args.identify_languages):
+        eprint("--dedup and --identify-languages need every book, so give them to 'merge' instead of the shards")
+        return False
+    return True
+
 
 gutIndexName = "GUTINDEX.ALL"
-TEXTEXTS = ["txt","utf8"]
+RDF_NS = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+DCTERMS_NS = "{http://purl.org/dc/terms/}"
+PGTERMS_NS = "{http://www.gutenberg.org/2009/pgterms/}"
+RDF_EBOOK_TAG = PGTERMS_NS+"ebook"
+RDF_TITLE_TAG = DCTERMS_NS+"title"
+RDF_LANGUAGE_TAG = DCTERMS_NS+"language"
+RDF_CREATOR_TAG = DCTERMS_NS+"creator"
+RDF_SUBJECT_TAG = DCTERMS_NS+"subject"
+RDF_SECTION_TAGS = (RDF_LANGUAGE_TAG, RDF_CREATOR_TAG, RDF_SUBJECT_TAG)
+RDF_VALUE_TAG = RDF_NS+"value"
+RDF_NAME_TAG = PGTERMS_NS+"name"
+CATALOG_RDF_REGEX = LazyRegex(r"pg(\d+)\.rdf$")
+LANGUAGE_SEPARATOR_REGEX = LazyRegex(r"[,&/\s]+") # Splits "English and French" or "Latin/Greek" into words
+LANGUAGE_CONJUNCTIONS = ("and", "with") # Whole words only, so "Icelandic" or "Scandinavian" stay intact
+GUTINDEX_LINE_REGEX = LazyRegex(r'[\w!-/:-@\[-`{-~]\s\s+\d*(\d|C)') # Python's re has no \p{P}, so spell out ASCII punctuation
 DEFAULT_LANGUAGE = "English"
 
 
@@ -53,24 +148,207 @@ DEFAULT_LANGUAGE = "English"
 #     filetypes = {}
 
 
+FoundBook = namedtuple("FoundBook", ["index", "textPath", "epubPath", "pdfPath", "rdfPath", "languages", "langFound",
+                                     "title", "author", "subjects", "encoding"])
+ScanRecord = namedtuple("ScanRecord", ["source", "index", "dirPath", "dirMtime", "rdfPath", "rdfMtime", "found"])
+
+
+# On-disk record of a scan, so 'list --incremental' only rescans directories that changed.
+class ScanManifest:
+    VERSION = "3"
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if not row or row[0] != self.VERSION: # Older layout; start over
+            self.conn.execute("DROP TABLE IF EXISTS books")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.VERSION,))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS books (source TEXT, bookIndex INTEGER, dirPath TEXT, dirMtime INTEGER, "
+                          "rdfPath TEXT, rdfMtime INTEGER, found INTEGER, textPath TEXT, epubPath TEXT, pdfPath TEXT, "
+                          "languages TEXT, langFound INTEGER, title TEXT, author TEXT, subjects TEXT, encoding TEXT, "
+                          "PRIMARY KEY (source, bookIndex))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)")
+        self.conn.commit()
+
+    # Return {(source, index): ScanRecord}
+    def load(self):
+        records = {}
+        for row in self.conn.execute("SELECT * FROM books"):
+            source, index, dirPath, dirMtime, rdfPath, rdfMtime, found = row[:7]
+            if found:
+                textPath, epubPath, pdfPath, languages, langFound, title, author, subjects, encoding = row[7:]
+                found = FoundBook(index, textPath, epubPath, pdfPath, rdfPath, languages.split(","), bool(langFound),
+                                  title, author, subjects.split("\n") if subjects else [], encoding)
+            else:
+                found = False
+            records[(source, index)] = ScanRecord(source, index, dirPath, dirMtime, rdfPath, rdfMtime, found)
+        return records
+
+    # Replace the stored scan with records
+    def save(self, records):
+        rows = []
+        for record in records:
+            row = (record.source, record.index, record.dirPath, record.dirMtime, record.rdfPath, record.rdfMtime)
+            found = record.found
+            if found:
+                row += (1, found.textPath, found.epubPath, found.pdfPath, ",".join(found.languages), int(found.langFound),
+                        found.title, found.author, "\n".join(found.subjects), found.encoding)
+            else:
+                row += (0, "", "", "", "", 0, "", "", "", "")
+            rows.append(row)
+        with self.conn:
+            self.conn.execute("DELETE FROM books")
+            self.conn.executemany("INSERT INTO books VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+
+    # Return {path: (size, mtime, digest)} for files hashed by earlier runs
+    def loadDigests(self):
+        return {row[0]: row[1:] for row in self.conn.execute("SELECT * FROM digests")}
+
+    # Store [(path, size, mtime, digest)]
+    def saveDigests(self, rows):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO digests VALUES (?,?,?,?)", rows)
+
+    def close(self):
+        self.conn.close()
+
+
+# Wall time, calls, bytes and filesystem calls per phase of a run, for --report. Phases are named
+# after the methods they time; a method's time includes the phases it calls, and time spent in worker
+# threads is summed. Bytes and filesystem calls are counted by the phase's own code (opens, stats,
+# directory listings, copies and links), not by the libraries it calls. A disabled PhaseStats
+# records nothing, so a run without --report doesn't pay for it.
+class PhaseStats:
+    FIELDS = ("seconds", "calls", "bytesRead", "bytesWritten", "fsCalls")
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {} # {name: [value of each field]}; added to once per call, so kept cheap
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds=0.0, calls=0, bytesRead=0, bytesWritten=0, fsCalls=0):
+        if not self.enabled:
+            return
+        with self.lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = [0.0, 0, 0, 0, 0]
+            phase[0] += seconds
+            phase[1] += calls
+            phase[2] += bytesRead
+            phase[3] += bytesWritten
+            phase[4] += fsCalls
+
+    def asDict(self):
+        with self.lock:
+            phases = {name: dict(zip(self.FIELDS, phase)) for name, phase in self.phases.items()}
+        for phase in phases.values():
+            phase["seconds"] = round(phase["seconds"], 6)
+        return phases
+
+
+# Decorator that times each call of a Gutenberg method as the phase name in self.stats
+def timedPhase(name):
+    def decorator(method):
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            if not self.stats.enabled:
+                return method(self, *args, **kwargs)
+            startTime = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.stats.add(name, time.perf_counter()-startTime, 1)
+        return timed
+    return decorator
+
+
+# Append-only record of finished placements in an organized directory, so an interrupted
+# move/copy/link can be rerun and pick up where it stopped
+class OrganizeJournal:
+    def __init__(self, path):
+        self.path = path
+        self.placed = {} # {(command, sourcePath, targetPath): (size, mtime)}
+        self.movedTo = {} # {sourcePath: targetPath} for moved files
+        if os.path.isfile(path):
+            with open(path, 'r') as journalFile:
+                for line in journalFile:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 5: # e.g. a line cut short by a crash
+                        continue
+                    command, size, mtime, sourcePath, targetPath = fields
+                    self.placed[(command, sourcePath, targetPath)] = (int(size), int(mtime))
+                    if command == "move":
+                        self.movedTo[sourcePath] = targetPath
+        self.lock = threading.Lock()
+        self.journalFile = open(path, 'a', buffering=1) # Line buffered, so each record survives a crash
+
+    def isPlaced(self, command, sourcePath, targetPath, verify=False):
+        targetPath = os.path.abspath(targetPath)
+        placement = self.placed.get((command, sourcePath, targetPath))
+        if not placement:
+            return False
+        if not verify:
+            return True
+        size, mtime = placement
+        try:
+            targetStat = os.lstat(targetPath)
+        except OSError:
+            return False
+        return targetStat.st_size == size and targetStat.st_mtime_ns == mtime
+
+    def record(self, command, sourcePath, targetPath):
+        targetPath = os.path.abspath(targetPath)
+        targetStat = os.lstat(targetPath)
+        line = "\t".join((command, str(targetStat.st_size), str(targetStat.st_mtime_ns), sourcePath, targetPath))+"\n"
+        with self.lock:
+            self.journalFile.write(line)
+            if command == "move":
+                self.movedTo[sourcePath] = targetPath
+
+    def close(self):
+        self.journalFile.close()
+
+
 class Gutenberg:
-    def __init__(self, gutenberg_dir):
+    def __init__(self, gutenberg_dir, jobs=1, manifestPath=None, incremental=False, dedupReportPath=None, keepCompressed=False,
+                 stats=None, shard=None, languageReportPath=None):
         self.dir = gutenberg_dir
+        self.jobs = jobs
+        self.manifestPath = manifestPath
+        self.incremental = incremental
+        self.previousScan = {}
+        self.scanRecords = []
+        self.dedupReportPath = dedupReportPath
+        self.languageReportPath = languageReportPath # Set to identify languages from the texts (see identifyLanguages)
+        self.keepCompressed = keepCompressed
+        self.duplicates = {} # {index: index of the book with identical content that was kept}
+        self.catalog = None
+        self.catalogPath = None
+        self.catalogMtime = 0
         self.cacheDir = os.path.join(self.dir,"cache","generated")
         self.filetypes = []
-        self.dirBooks = {}
-        self.books = {}
-        self.cacheBooks = {}
-        self.languages = {}
+        self.dirBooks = set() # Indices found in the directory structure
+        self.books = {} # The one Book record per index; everything else refers to it by index
+        self.cacheBooks = set() # Indices found in the cache
+        self.languages = {} # {lang: {fileFormat: array of indices into self.books}}
         self.lastIndex = 0
-        self.lineRegex = re.compile('[\w\p{P}]\s\s+\d*(\d|C)')
-        self.langSecRegex = re.compile("<dcterms:language>.{1,100}<rdf:value.{1,100}>(\w{1,100})<\/rdf:value>.{1,100}</dcterms:language>") # Grab language code in RDF file
         # self.textLangRegex = re.compile("\nLanguage: ([a-zA-Z]+)\n")
         self.unlisted = []
         self.noLangBooks = {}
-        self.pdfs = {}
+        self.pdfs = {} # {index: True} for books only found as pdf, in the order they were found
         self.epubs = {}
         self.txts = {}
+        self.cacheIndexDirs = None # Filled by walkCacheDirs; lets getCacheDir skip a stat per book
+        self.textEncodings = None # {path: encoding} of loaded txt books, built by guessBookEncoding
+        self.cacheOnlyBooks = [] # Indices found only in the cache, and only in the directory structure
+        self.dirOnlyBooks = []
+        self.notFoundBooks = [] # Indices below the highest one found in neither
+        self.stats = stats or PhaseStats(enabled=False) # Pass a PhaseStats to record the phases of a run
+        self.shard = shard # (shardI, numShards): only scan the books whose index % numShards is shardI
 
     # Return the language of the book and the index of the line after the last line of attributes
     def parseBookAttributes(self, lines, lineI):
@@ -78,40 +356,112 @@ class Gutenberg:
         # while
         return language, lineI
 
-    def getRDFLangs(self, rdfFilepath):
-        with open(rdfFilepath, 'r') as rdfFile:
-            fileStr = rdfFile.read().replace("\n","")
-            langStrs = self.langSecRegex.findall(fileStr)
-            if not langStrs or not len(langStrs):
-                print("Could not find lang in "+rdfFilepath)
-            return langStrs
-
-    def getLangsFromText(self, textPath):
-        with open(textPath, 'r') as textFile:
-            for line in textFile:
-                line = line.strip()
-                if line.startswith("Language:"):
-                    langs = re.split(",|&|and|with|\s|/",line.split(":")[1].strip().lower())
-                    langStrs = []
-                    for lang in langs:
-                        if lang:
-                            lang = re.sub(r'[^a-zA-Z]+','',lang)
-                            if len(lang):
-                                langStrs.append(lang)
-                    return langStrs
-                if line.startswith("***"):
+    # Read languages, title, author and subjects from an RDF file (a path or a binary file object)
+    # in one streaming pass. Parsing stops at the end of the pgterms:ebook element.
+    @timedPhase("getRDFMetadata")
+    def getRDFMetadata(self, rdfFile, name=None):
+        if isinstance(rdfFile, str):
+            try:
+                with open(rdfFile, 'rb') as openFile:
+                    metadata = self.parseRDFMetadata(openFile, rdfFile)
+                    self.stats.add("getRDFMetadata", bytesRead=openFile.tell(), fsCalls=1)
+                    return metadata
+            except OSError as e:
+                eprint("Could not read "+rdfFile+": "+str(e))
+                return {"languages": [], "title": "", "author": "", "subjects": []}
+        return self.parseRDFMetadata(rdfFile, name)
+
+    def parseRDFMetadata(self, rdfFile, name=None):
+        import xml.etree.ElementTree as ET
+        name = name or str(rdfFile)
+        metadata = {"languages": [], "title": "", "author": "", "subjects": []}
+        authors = []
+        section = None # The dcterms:language/creator/subject element being read
+        try:
+            for event, elem in ET.iterparse(rdfFile, events=("start", "end")):
+                tag = elem.tag
+                if event == "start":
+                    if section is None and tag in RDF_SECTION_TAGS:
+                        section = tag
+                    continue
+                if tag == RDF_VALUE_TAG and elem.text:
+                    if section == RDF_LANGUAGE_TAG:
+                        if elem.text.strip() not in metadata["languages"]: # A repeated language would list the book twice
+                            metadata["languages"].append(elem.text.strip())
+                    elif section == RDF_SUBJECT_TAG:
+                        metadata["subjects"].append(elem.text.strip())
+                elif tag == RDF_NAME_TAG and section == RDF_CREATOR_TAG and elem.text:
+                    authors.append(elem.text.strip())
+                elif tag == RDF_TITLE_TAG and not metadata["title"] and elem.text:
+                    metadata["title"] = " ".join(elem.text.split())
+                elif tag == RDF_EBOOK_TAG:
                     break
+                if tag == section:
+                    section = None
+                if section is None:
+                    elem.clear()
+        except ET.ParseError as e:
+            eprint("Could not parse "+name+": "+str(e))
+        metadata["author"] = "; ".join(authors)
+        if not metadata["languages"]:
+            print("Could not find lang in "+name)
+        return metadata
+
+    # Stream the consolidated catalog (rdf-files.tar.bz2) once and keep each book's metadata,
+    # so scanBook doesn't need to open a pg<index>.rdf file per book.
+    @timedPhase("loadCatalog")
+    def loadCatalog(self, catalogPath):
+        import tarfile
+        self.catalog = {}
+        self.catalogPath = os.path.abspath(catalogPath)
+        self.catalogMtime = self.getMtime(catalogPath)
+        with tarfile.open(catalogPath, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                match = CATALOG_RDF_REGEX.search(member.name)
+                if not match:
+                    continue
+                self.catalog[int(match.group(1))] = self.parseRDFMetadata(tar.extractfile(member), member.name)
+        self.stats.add("loadCatalog", bytesRead=os.path.getsize(catalogPath), fsCalls=1)
+        print("Number of books in catalog: "+str(len(self.catalog)))
+
+    def getRDFLangs(self, rdfFilepath):
+        return self.getRDFMetadata(rdfFilepath)["languages"]
+
+    @timedPhase("getLangsFromText")
+    def getLangsFromText(self, textPath, encoding="utf-8"):
+        try:
+            with io.TextIOWrapper(openBookFile(textPath), encoding=encoding, errors="replace") as textFile:
+                try:
+                    for line in textFile:
+                        line = line.strip()
+                        if line.startswith("Language:"):
+                            langs = LANGUAGE_SEPARATOR_REGEX.split(line.split(":")[1].strip().lower())
+                            langStrs = []
+                            for lang in langs:
+                                if lang:
+                                    lang = re.sub(r'[^a-zA-Z]+','',lang)
+                                    if len(lang) and lang not in LANGUAGE_CONJUNCTIONS and lang not in langStrs:
+                                        langStrs.append(lang)
+                            return langStrs
+                        if line.startswith("***"):
+                            break
+                finally:
+                    self.stats.add("getLangsFromText", bytesRead=textFile.buffer.tell(), fsCalls=1)
+        except getBookReadErrors(): # Unreadable or corrupt; the book gets the default language
+            return False
         return False
 
-    def addBookLang(self, lang, book, fileFormat):
+    def addBookLang(self, lang, index, fileFormat):
         langFormats = None
         if lang not in self.languages:
             langFormats = {}
         else:
             langFormats = self.languages[lang]
         if fileFormat not in langFormats:
-            langFormats[fileFormat] = []
-        langFormats[fileFormat].append(book)
+            langFormats[fileFormat] = array('l')
+        langFormats[fileFormat].append(index)
         self.languages[lang] = langFormats
 
     def getIndexPath(self, index):
@@ -148,82 +498,258 @@ class Gutenberg:
                 return True
         return False
 
-    def findFile(self, index, dirPath):
-        if os.path.isdir(dirPath):
+    def isIndexName(self, name):
+        return name.isdigit() and name.isascii() and not name.startswith("0")
+
+    # Walk the digit tree (e.g. 1/3/0/8/13083) once with scandir and return {index: bookDir}.
+    # Books with an index below 10 live in 0/<index>; every other book lives in the directory
+    # named by all but the last digit of its index.
+    @timedPhase("walkIndexDirs")
+    def walkIndexDirs(self):
+        indexDirs = {}
+        pending = []
+        with os.scandir(self.dir) as entries:
+            for entry in entries:
+                if len(entry.name) == 1 and entry.name.isdigit() and entry.is_dir():
+                    pending.append((entry.name, entry.path))
+        numScanned = 1
+        while pending:
+            prefix, dirPath = pending.pop()
+            numScanned += 1
+            try:
+                entries = os.scandir(dirPath)
+            except OSError as e:
+                eprint("Could not scan "+dirPath+": "+str(e))
+                continue
+            with entries:
+                for entry in entries:
+                    name = entry.name
+                    if not name.isdigit() or not name.isascii() or not entry.is_dir():
+                        continue
+                    if prefix == "0":
+                        if len(name) == 1 and name != "0":
+                            indexDirs[int(name)] = entry.path
+                    elif len(name) == len(prefix)+1 and name.startswith(prefix):
+                        indexDirs[int(name)] = entry.path
+                    elif len(name) == 1:
+                        pending.append((prefix+name, entry.path))
+        self.stats.add("walkIndexDirs", fsCalls=numScanned)
+        return indexDirs
+
+    # Return {index: cacheDir} for every book directory in cache/generated.
+    @timedPhase("walkCacheDirs")
+    def walkCacheDirs(self):
+        cacheDirs = {}
+        try:
+            entries = os.scandir(self.cacheDir)
+        except OSError:
+            return cacheDirs
+        with entries:
+            for entry in entries:
+                if self.isIndexName(entry.name) and entry.is_dir():
+                    cacheDirs[int(entry.name)] = entry.path
+        self.stats.add("walkCacheDirs", fsCalls=1)
+        return cacheDirs
+
+    # Return (rank, encoding) for a txt file name by Gutenberg's suffix convention; lower ranks are preferred
+    def getTextVariant(self, fileName):
+        for rank, (suffix, encoding) in enumerate(TXT_VARIANTS):
+            if fileName.endswith(suffix):
+                return rank, encoding
+        return len(TXT_VARIANTS), "utf-8"
+
+    # Confirm the encoding of a text from its first bytes (see sniffTextEncoding)
+    @timedPhase("getTextEncoding")
+    def getTextEncoding(self, textPath, expected="utf-8"):
+        encoding, bytesRead = sniffTextEncoding(textPath, expected)
+        self.stats.add("getTextEncoding", bytesRead=bytesRead, fsCalls=1)
+        return encoding
+
+    # Choose the text, epub and pdf files in a book directory and detect the book's languages.
+    # Only reads the filesystem, so it can run in worker threads; addFoundBook merges the result.
+    @timedPhase("scanBook")
+    def scanBook(self, index, dirPath):
+        try:
             bookFiles = os.listdir(dirPath)
-            textPath = ""
-            epubPath = ""
-            pdfPath = ""
-            rdfPath = ""
-            indexStr = str(index)
-            for file in bookFiles:
-                if "readme" in file or indexStr not in file:
+        except OSError: # Missing or not a directory
+            self.stats.add("scanBook", fsCalls=1)
+            return False
+        numFsCalls = 1
+        textPath = ""
+        epubPath = ""
+        pdfPath = ""
+        rdfPath = ""
+        textVariant = None
+        archivePaths = []
+        indexStr = str(index)
+        cacheTextNames = ["pg"+indexStr+extension for extension in CACHE_TEXT_EXTENSIONS]
+        for file in sorted(bookFiles): # Sorted, so ties don't depend on directory order
+            if "readme" in file or indexStr not in file:
+                continue
+            if file.endswith(".txt") or file in cacheTextNames:
+                filename, file_extension = os.path.splitext(file)
+                if file_extension == ".txt" and self.containsAlpha(filename): # This check is debatable
                     continue
-                if file.endswith(".txt"):
-                    filename, file_extension = os.path.splitext(file)
-                    if self.containsAlpha(filename): # This check is debatable
-                        continue
+                variant = self.getTextVariant(file)
+                if textVariant is None or variant[0] < textVariant[0]:
+                    textVariant = variant
                     textPath = os.path.join(dirPath, file)
-                elif file.endswith(str(index)+".epub"):
-                    epubPath = os.path.join(dirPath, file)
-                elif file.endswith(".pdf"):
-                    pdfPath = os.path.join(dirPath, file)
-                elif file.endswith(".rdf"):
-                    rdfPath = os.path.join(dirPath, file)
-            # print("zip path:" +os.path.join(path,indexStr+".zip"))
-            langs = None
+            elif file.endswith(str(index)+".epub"):
+                epubPath = os.path.join(dirPath, file)
+            elif file.endswith(".pdf"):
+                pdfPath = os.path.join(dirPath, file)
+            elif file.endswith(".rdf"):
+                rdfPath = os.path.join(dirPath, file)
+            elif file.endswith(ARCHIVE_EXTENSION) and not self.containsAlpha(os.path.splitext(file)[0]): # Not the -h.zip html archives
+                archivePaths.append(os.path.join(dirPath, file))
+        # A txt file in a zip archive is a candidate too, behind a loose file of the same variant.
+        # Only archives whose own name could beat the current choice are opened.
+        for archivePath in sorted(archivePaths, key=lambda path: self.getTextVariant(path[:-len(ARCHIVE_EXTENSION)]+".txt")):
+            if textVariant is not None and self.getTextVariant(archivePath[:-len(ARCHIVE_EXTENSION)]+".txt")[0] >= textVariant[0]:
+                break
+            numFsCalls += 1
+            for member in sorted(listArchiveTexts(archivePath)):
+                memberName = os.path.basename(member)
+                if "readme" in memberName or indexStr not in memberName or self.containsAlpha(os.path.splitext(memberName)[0]):
+                    continue
+                variant = self.getTextVariant(memberName)
+                if textVariant is None or variant[0] < textVariant[0]:
+                    textVariant = variant
+                    textPath = os.path.join(archivePath, member)
+        if not len(textPath) and not len(epubPath) and not len(pdfPath):
+            self.stats.add("scanBook", fsCalls=numFsCalls)
+            return False
+        encoding = ""
+        if len(textPath):
+            encoding = self.getTextEncoding(textPath, textVariant[1])
+        langs = None
+        langFound = True
+        metadata = {"title": "", "author": "", "subjects": []}
+        if self.catalog is not None and index in self.catalog:
+            rdfPath = self.catalogPath
+            metadata = self.catalog[index]
+            langs = metadata["languages"]
+        else:
             if not len(rdfPath):
+                numFsCalls += 1
                 rdfPath = self.getCacheRDFPath(index) # Cache consistently contains the rdf files
-            if len(textPath) or len(epubPath) or len(pdfPath):
-                if len(rdfPath):
-                    langs = self.getRDFLangs(rdfPath)
-                if not langs and len(textPath):
-                    langs = self.getLangsFromText(textPath)
-                if not langs or not len(langs):
-                    langs = ["en"]
-                    self.noLangBooks[index] = True
-
-            book = False
-            fileFormat = ""
-            if len(textPath):
-                book = Book(index, textPath, languages=langs)
-                if index not in self.books or not self.books[index].path.endswith(".txt"):
-                    self.books[index] = book
-                    if index in self.epubs:
-                        del self.epubs[index]
-                    if index in self.pdfs:
-                        del self.pdfs[index]
-                fileFormat = "txt"
-            elif len(epubPath):
-                book = Book(index, epubPath, languages=langs)
-                if index not in self.books:
-                    self.books[index] = book
-                    self.epubs[index] = book
-                else:
-                    bookPath = self.books[index].path
-                    if not bookPath.endswith(".txt") and not bookPath.endswith(".epub"):
-                        self.books[index] = book
-                        self.epubs[index] = book
-                fileFormat = "epub"
-            elif len(pdfPath):
-                book = Book(index, pdfPath, languages=langs)
-                if index not in self.books:
-                    self.books[index] = book
-                    self.pdfs[index] = book
-                else:
-                    bookPath = self.books[index].path
-                    if not bookPath.endswith(".txt") and not bookPath.endswith(".epub"):
-                        self.books[index] = book
-                        self.pdfs[index] = book
-                fileFormat = "pdf"
-            else:
-                return False
-            self.dirBooks[index] = book
-            return book
-            # txtPath = os.path.join(self.cacheDir,indexStr,"pg"+indexStr+".txt.utf8.gzip")
-            # txtPath = os.path.join(bookDir,"pg"+indexStr+".txt.utf8")
-            # print("txtPath: "+txtPath)
-        return False
+            if len(rdfPath):
+                metadata = self.getRDFMetadata(rdfPath)
+                langs = metadata["languages"]
+        if not langs and len(textPath):
+            langs = self.getLangsFromText(textPath, encoding)
+        if not langs or not len(langs):
+            langs = ["en"]
+            langFound = False
+        self.stats.add("scanBook", fsCalls=numFsCalls)
+        return FoundBook(index, textPath, epubPath, pdfPath, rdfPath, langs, langFound,
+                         metadata["title"], metadata["author"], metadata["subjects"], encoding)
+
+    # Merge a scanBook result into books, epubs and pdfs. txt beats epub, which beats pdf.
+    def addFoundBook(self, found):
+        index = found.index
+        if not found.langFound:
+            self.noLangBooks[index] = True
+        if len(found.textPath):
+            path = found.textPath
+            fileFormat = "txt"
+        elif len(found.epubPath):
+            path = found.epubPath
+            fileFormat = "epub"
+        elif len(found.pdfPath):
+            path = found.pdfPath
+            fileFormat = "pdf"
+        else:
+            return False
+        current = self.books.get(index)
+        if fileFormat == "txt":
+            replace = not current or current.format != "txt"
+        elif fileFormat == "epub":
+            replace = not current or current.format not in ("txt", "epub")
+        else:
+            replace = not current or current.format == "pdf"
+        if not replace:
+            return current
+        book = Book(index, path, languages=found.languages, title=found.title, author=found.author,
+                    subjects=found.subjects, fileFormat=fileFormat, encoding=found.encoding if fileFormat == "txt" else "")
+        self.books[index] = book
+        if fileFormat == "txt":
+            self.epubs.pop(index, None)
+            self.pdfs.pop(index, None)
+        elif fileFormat == "epub":
+            self.pdfs.pop(index, None)
+            self.epubs[index] = True
+        else:
+            self.pdfs[index] = True
+        return book
+
+    def findFile(self, index, dirPath):
+        found = self.scanBook(index, dirPath)
+        if not found:
+            return False
+        return self.addFoundBook(found)
+
+    def getMtime(self, path):
+        if not path:
+            return 0
+        if path == self.catalogPath and self.catalogMtime:
+            return self.catalogMtime
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return 0
+
+    # Whether a scan would read the book's metadata from the same place as the recorded one, and it hasn't
+    # changed: the catalog given for this run, the book directory's rdf file or the cache's
+    def isRDFUnchanged(self, index, record):
+        if not record.found: # No book files, so the rdf file was never read
+            return True
+        if self.catalog is not None and index in self.catalog:
+            return record.rdfPath == self.catalogPath and self.getMtime(record.rdfPath) == record.rdfMtime
+        if record.rdfPath:
+            if os.path.dirname(record.rdfPath) != record.dirPath and record.rdfPath != self.getCacheRDFPath(index):
+                return False # Read from a catalog, or from another copy of the mirror
+            return self.getMtime(record.rdfPath) == record.rdfMtime
+        return not self.getCacheRDFPath(index)
+
+    # scanBook plus the mtimes needed to skip the book next time. With incremental set, a book
+    # whose directory and rdf file are unchanged since the last manifest isn't scanned again. The
+    # directory has to be the recorded one too: a moved or copied mirror keeps its mtimes.
+    @timedPhase("scanIndex")
+    def scanIndex(self, source, index, dirPath):
+        dirMtime = self.getMtime(dirPath)
+        if self.incremental:
+            record = self.previousScan.get((source, index))
+            if record and record.dirPath == dirPath and record.dirMtime == dirMtime and self.isRDFUnchanged(index, record):
+                self.stats.add("scanIndex", fsCalls=2) # The directory's and rdf file's mtimes
+                return record.found, record
+        found = self.scanBook(index, dirPath)
+        rdfPath = found.rdfPath if found else ""
+        self.stats.add("scanIndex", fsCalls=2)
+        record = ScanRecord(source, index, dirPath, dirMtime, rdfPath, self.getMtime(rdfPath), found)
+        return found, None if not dirMtime else record
+
+    # Scan {index: dir} in index order and merge each result, yielding (index, book or False).
+    # With jobs > 1 the scans run in a thread pool, but results are still merged in index
+    # order, so the outcome is identical to a serial scan.
+    def findFiles(self, indexDirs, source):
+        indices = sorted(indexDirs)
+        dirPaths = [indexDirs[index] for index in indices]
+        executor = None
+        if self.jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=self.jobs)
+            results = executor.map(self.scanIndex, repeat(source), indices, dirPaths)
+        else:
+            results = map(self.scanIndex, repeat(source), indices, dirPaths)
+        try:
+            for index, (found, record) in zip(indices, results):
+                if record:
+                    self.scanRecords.append(record)
+                yield index, self.addFoundBook(found) if found else False
+        finally:
+            if executor:
+                executor.shutdown()
 
     def getCachePath(self, index):
         indexStr = str(index)
@@ -237,9 +763,11 @@ class Gutenberg:
             rdfPath = os.path.join(cacheDir,"pg"+str(index)+".rdf") # Trusting that the format pg<index>.rdf won't change
             if os.path.isfile(rdfPath):
                 return rdfPath
-        return rdfPath
+        return ""
 
     def getCacheDir(self, index):
+        if self.cacheIndexDirs is not None:
+            return self.cacheIndexDirs.get(index, False)
         indexStr = str(index)
         cacheDir = os.path.join(self.cacheDir,indexStr)
         if os.path.isdir(cacheDir):
@@ -250,7 +778,7 @@ class Gutenberg:
     def isBookIndexLine(self, listingLine, bookIndex):
         if listingLine.startswith("<==End of GUTINDEX.ALL==>") or listingLine.startswith("GUTINDEX"):
             return -1
-        if str(bookIndex-1) in listingLine or self.lineRegex.match(listingLine):
+        if str(bookIndex-1) in listingLine or GUTINDEX_LINE_REGEX.match(listingLine):
         # if str(bookIndex-1) in listingLine:
             print("listing line book index: "+listingLine)
             return 1
@@ -355,9 +883,168 @@ class Gutenberg:
             if bookIndex < 50000:
                 break
 
-    def loadList(self):
-        self.languages = {}
-        with open(self.dir, 'r') as listFile:
+    # The hex digest of a book file's content, or None if it can't be read
+    @timedPhase("hashFile")
+    def hashFile(self, path):
+        import hashlib
+        digest = hashlib.blake2b(digest_size=20)
+        numBytes = 0
+        try:
+            with openBookFile(path) as hashedFile:
+                for chunk in iter(lambda: hashedFile.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    numBytes += len(chunk)
+        except getBookReadErrors() as e:
+            eprint("Couldn't hash "+path+": "+(str(e) or type(e).__name__))
+            return None
+        finally:
+            self.stats.add("hashFile", bytesRead=numBytes, fsCalls=1)
+        return digest.hexdigest()
+
+    # Drop books whose file is byte-identical to a book with a lower index, and write the
+    # duplicates to dedupReportPath. Only files that share their size with another file are
+    # hashed, and digests are cached in the manifest by (path, size, mtime).
+    @timedPhase("removeDuplicates")
+    def removeDuplicates(self, manifest=None):
+        sizes = {}
+        for index, book in self.books.items():
+            try:
+                size, mtime = statBookFile(book.path)
+            except OSError:
+                continue
+            sizes.setdefault(size, []).append((index, book.path, size, mtime))
+        self.stats.add("removeDuplicates", fsCalls=len(self.books))
+        candidates = sorted(entry for group in sizes.values() if len(group) > 1 for entry in group)
+        cachedDigests = manifest.loadDigests() if manifest else {}
+        digests = {}
+        toHash = []
+        for index, path, size, mtime in candidates:
+            cached = cachedDigests.get(path)
+            if cached and cached[0] == size and cached[1] == mtime:
+                digests[path] = cached[2]
+            else:
+                toHash.append((path, size, mtime))
+        if self.jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                hashed = list(executor.map(self.hashFile, [path for path, size, mtime in toHash]))
+        else:
+            hashed = [self.hashFile(path) for path, size, mtime in toHash]
+        newDigests = []
+        for (path, size, mtime), digest in zip(toHash, hashed):
+            if digest is None: # Unreadable, so it's kept and its digest isn't cached
+                continue
+            digests[path] = digest
+            newDigests.append((path, size, mtime, digest))
+        if manifest:
+            manifest.saveDigests(newDigests)
+        print("Files hashed for deduplication: "+str(len(toHash))+" (reused "+str(len(candidates)-len(toHash))+" cached digests)")
+        canonical = {}
+        numDuplicates = 0
+        with open(self.dedupReportPath, 'w') as reportFile:
+            for index, path, size, mtime in candidates:
+                digest = digests.get(path)
+                if digest is None:
+                    continue
+                if digest not in canonical:
+                    canonical[digest] = index
+                    continue
+                keptIndex = canonical[digest]
+                reportFile.write(str(index)+"\t"+path+"\tduplicates\t"+str(keptIndex)+"\t"+self.books[keptIndex].path+"\n")
+                self.duplicates[index] = keptIndex
+                del self.books[index]
+                self.epubs.pop(index, None)
+                self.pdfs.pop(index, None)
+                numDuplicates += 1
+        print("Duplicate books removed: "+str(numDuplicates)+" (see "+self.dedupReportPath+")")
+
+    # RDF files give languages as codes (en, fr, enm), the "Language:" line of a text as names (english)
+    def isLanguageCode(self, lang):
+        return len(lang) <= 3 and lang.isalpha()
+
+    # Identify the language of each txt book from its text (see language_id.py). The identifier is trained
+    # on up to MAX_TRAINING_BOOKS books of each language labeled with one language code. Books without a
+    # language get the identified one, and books labeled only with languages the identifier knows, none
+    # of which is the identified one, are reported. Both are written to languageReportPath as
+    # index, path, labeled languages (none if filled), identified language, margin and "filled" or "disagrees".
+    @timedPhase("identifyLanguages")
+    def identifyLanguages(self):
+        import language_id
+        txtBooks = [book for book in self.books.values() if book.format == "txt"]
+        trainingBooks = []
+        numTraining = {}
+        for book in txtBooks:
+            if book.index in self.noLangBooks or len(book.languages) != 1 or not self.isLanguageCode(book.languages[0]):
+                continue
+            lang = book.languages[0]
+            if numTraining.get(lang, 0) < language_id.MAX_TRAINING_BOOKS:
+                numTraining[lang] = numTraining.get(lang, 0)+1
+                trainingBooks.append(book)
+        trainingSamples = list(language_id.readSamples([(book.path, book.encoding or "utf-8") for book in trainingBooks], self.jobs))
+        identifier = language_id.LanguageIdentifier()
+        identifier.train(trainingSamples, [book.languages[0] for book in trainingBooks])
+        print("Languages identified from text: "+", ".join(identifier.languages)+" (trained on "+str(len(trainingBooks))+" books)")
+        knownLangs = set(identifier.languages)
+        numFilled = 0
+        numDisagreeing = 0
+        samples = language_id.readSamples([(book.path, book.encoding or "utf-8") for book in txtBooks], self.jobs)
+        with open(self.languageReportPath, 'w') as reportFile:
+            for start in range(0, len(txtBooks), language_id.BATCH_SIZE):
+                batch = txtBooks[start:start+language_id.BATCH_SIZE]
+                for book, (lang, margin) in zip(batch, identifier.identify([next(samples) for book in batch])):
+                    if not lang or margin < language_id.MIN_MARGIN:
+                        continue
+                    if book.index in self.noLangBooks:
+                        result = "filled"
+                    elif lang not in book.languages and all(label in knownLangs for label in book.languages):
+                        result = "disagrees"
+                    else:
+                        continue
+                    labels = "" if result == "filled" else ",".join(book.languages) # Not the default language
+                    reportFile.write(str(book.index)+"\t"+book.path+"\t"+labels+"\t"+lang+"\t"
+                                     +"{:.3f}".format(margin)+"\t"+result+"\n")
+                    if result == "filled":
+                        book.languages = [lang]
+                        del self.noLangBooks[book.index]
+                        numFilled += 1
+                    else:
+                        numDisagreeing += 1
+        self.stats.add("identifyLanguages", fsCalls=len(trainingBooks)+len(txtBooks))
+        print("Books given the language identified from their text: "+str(numFilled))
+        print("Books whose language labels disagree with their text: "+str(numDisagreeing)+" (see "+self.languageReportPath+")")
+
+    # Write clusters of near-duplicate txt books to reportPath. entries are (lang, fileFormat, path)
+    # as from iterListFile, and default to the loaded books.
+    @timedPhase("findNearDuplicates")
+    def findNearDuplicates(self, reportPath, entries=None, threshold=0.8):
+        import near_duplicates
+        if entries is None:
+            entries = self.iterLanguages()
+        paths = list(dict.fromkeys(path for lang, fileFormat, path in entries if fileFormat == "txt")) # Once per book
+        guesses = [self.guessBookEncoding(path) for path in paths]
+        print("Computing MinHash signatures for "+str(len(paths))+" books")
+        clusters = near_duplicates.findNearDuplicates(paths, [encoding for encoding, confirmed in guesses], jobs=self.jobs,
+                                                      threshold=threshold, confirmed=[confirmed for encoding, confirmed in guesses])
+        with open(reportPath, 'w') as reportFile:
+            for clusterI, cluster in enumerate(clusters):
+                reportFile.write("\n CLUSTER "+str(clusterI+1)+" ("+str(len(cluster))+" books):\n")
+                for path, similarity in cluster:
+                    reportFile.write("{:.2f} ".format(similarity)+path+"\n")
+        print("Near-duplicate clusters: "+str(len(clusters))+", books in them: "+str(sum(len(cluster) for cluster in clusters)))
+
+    # Return (encoding, confirmed) for a txt book: the encoding recorded for a loaded book, or else the one its
+    # name suggests, unconfirmed. The worker that reads the book then confirms it with sniffTextEncoding, so
+    # books of a list file aren't all opened one after another before the workers start.
+    def guessBookEncoding(self, textPath):
+        if self.textEncodings is None:
+            self.textEncodings = {book.path: book.encoding for book in self.books.values() if book.encoding}
+        if textPath in self.textEncodings:
+            return self.textEncodings[textPath], True
+        return self.getTextVariant(textPath)[1], False
+
+    # Yield (lang, fileFormat, path) for each book in a list file written by 'list', as it is read.
+    def iterListFile(self, listPath):
+        with open(listPath, 'r') as listFile:
             lang = "en"
             fileFormat = "txt"
             for line in listFile:
@@ -366,16 +1053,98 @@ class Gutenberg:
                     splitLine = line.split()
                     if len(splitLine) > 2 and splitLine[1] == "FORMAT":
                         fileFormat = splitLine[2][:-1] # Don't include the colon
-                        self.languages[lang][fileFormat] = []
-                        continue
                     elif len(splitLine) > 1 and splitLine[0] == "LANGUAGE":
                         lang = splitLine[1][:-1] # Don't include the colon
-                        self.languages[lang] = {}
-                        continue
                     else:
-                        path = line
-                        self.languages[lang][fileFormat].append(Book(path=path))
+                        yield lang, fileFormat, line
+
+    # Books in a list file are keyed by the index in their directory name (13083/13083-8.txt),
+    # or by a negative placeholder when that's missing or already taken
+    def getListIndex(self, path):
+        if ARCHIVE_EXTENSION+"/" in path: # 13083/13083-8.zip/13083-8.txt
+            path = path[:path.rfind(ARCHIVE_EXTENSION+"/")+len(ARCHIVE_EXTENSION)]
+        dirName = os.path.basename(os.path.dirname(path))
+        if self.isIndexName(dirName):
+            index = int(dirName)
+            if index not in self.books:
+                return index
+        return -len(self.books)-1
+
+    @timedPhase("loadList")
+    def loadList(self):
+        self.languages = {}
+        self.books = {}
+        for lang, fileFormat, path in self.iterListFile(self.dir):
+            index = self.getListIndex(path)
+            self.books[index] = Book(index, path, languages=(lang,), fileFormat=fileFormat)
+            self.addBookLang(lang, index, fileFormat)
+
+    # Load the books found by the last 'list' scan from its scan manifest (default: self.manifestPath)
+    # instead of scanning the mirror again, merged as loadCorpus merges them. The manifest keeps
+    # what the scan found, so books left out by --dedup are loaded too. Return the number of books.
+    @timedPhase("loadScan")
+    def loadScan(self, manifestPath=None):
+        manifestPath = manifestPath or self.manifestPath
+        if not manifestPath or not os.path.isfile(manifestPath):
+            raise FileNotFoundError(errno.ENOENT, "No scan manifest", manifestPath)
+        self.addScanRecords(self.loadScanRecords(manifestPath))
+        self.languages = {}
+        for index, book in self.books.items():
+            for lang in book.languages:
+                self.addBookLang(lang, index, book.format)
+        return len(self.books)
+
+    # Return {(source, index): ScanRecord} from a scan manifest or a shard's partial result
+    def loadScanRecords(self, manifestPath):
+        manifest = ScanManifest(manifestPath)
+        try:
+            return manifest.load()
+        finally:
+            manifest.close()
+
+    # Replace the loaded books with the ones found in records, merged in the order loadCorpus
+    # scans them: the directory structure, then the cache, each in index order
+    def addScanRecords(self, records):
+        self.books = {}
+        self.dirBooks = set()
+        self.cacheBooks = set()
+        self.noLangBooks = {}
+        self.epubs = {}
+        self.pdfs = {}
+        for source, index in sorted(records, key=lambda key: (key[0] != "dir", key[1])):
+            found = records[(source, index)].found
+            if found and self.addFoundBook(found):
+                (self.dirBooks if source == "dir" else self.cacheBooks).add(index)
+
+    # The part of {index: dir} that belongs to this run's shard
+    def getShardDirs(self, indexDirs):
+        shardI, numShards = self.shard
+        return {index: dirPath for index, dirPath in indexDirs.items() if index % numShards == shardI}
+
+    # Combine the partial results of 'list --shard' runs into this corpus, as if one 'list' had scanned
+    # the whole mirror: books are merged with the same txt, epub, pdf priority, duplicates are removed
+    # if a report path was given, the scan manifest is saved and the statistics are printed.
+    @timedPhase("mergeShards")
+    def mergeShards(self, shardPaths):
+        records = {}
+        for shardPath in shardPaths:
+            records.update(self.loadScanRecords(shardPath))
+        self.addScanRecords(records)
+        manifest = ScanManifest(self.manifestPath) if self.manifestPath else None
+        try:
+            if self.dedupReportPath:
+                self.removeDuplicates(manifest)
+            if self.languageReportPath:
+                self.identifyLanguages()
+            if manifest:
+                manifest.save(record for key, record in sorted(records.items()))
+        finally:
+            if manifest:
+                manifest.close()
+        print("Books merged from "+str(len(shardPaths))+" shards: "+str(len(self.books)))
+        self.summarizeCorpus()
 
+    @timedPhase("loadCorpus")
     def loadCorpus(self):
         # self.parseIndex()
         # for bookI in range(self.lastIndex+1):
@@ -384,60 +1153,55 @@ class Gutenberg:
         if os.path.isfile(self.dir):
             self.loadList()
             return
-        bookI = 1
-        numMissing = 0
-        missingThreshold = 100
-        tempUnlisted = []
+        manifest = None
+        if self.manifestPath:
+            manifest = ScanManifest(self.manifestPath)
+            if self.incremental:
+                self.previousScan = manifest.load()
+                print("Books in scan manifest: "+str(len(self.previousScan)))
+        self.scanRecords = []
+        self.cacheIndexDirs = self.walkCacheDirs()
+        indexDirs = self.walkIndexDirs()
+        cacheIndexDirs = self.cacheIndexDirs
+        if self.shard:
+            indexDirs = self.getShardDirs(indexDirs)
+            cacheIndexDirs = self.getShardDirs(cacheIndexDirs) # getCacheDir still sees the whole cache
         # Search Gutenberg directory structure
-        while 1: # We don't know yet how many books there are (the index may not be up to date)
-            book = self.getIndexPath(bookI)
+        for bookI, book in self.findFiles(indexDirs, "dir"):
             # print("Book path for "+str(bookI)+": "+str(bookPath))
             if not book:
-                numMissing += 1
-                if numMissing > missingThreshold:
-                    break
-                else:
-                    tempUnlisted.append(bookI)
-                    bookI += 1
-                    continue
-            bookPath = book.path
-            if len(tempUnlisted):
-                self.unlisted.extend(tempUnlisted)
-                tempUnlisted = []
-            numMissing = 0
-
-            newBook = Book(bookI, bookPath)
-            self.dirBooks[bookI] = newBook
-            bookI += 1
-        print("Number of books found in Gutenberg directories: "+str(len(self.dirBooks)))
-        print("Number of book indices skipped: "+str(len(self.unlisted)))
-        self.cacheBooks = {}
-        cacheUnlisted = []
+                continue
+            self.dirBooks.add(bookI)
+        self.cacheBooks = set()
         # Search cache
-        bookI = 1
-        numMissing = 0
-        tempUnlisted = []
-        while 1: # We don't know yet how many books there are (the index may not be up to date)
-            book = self.getCachePath(bookI)
+        for bookI, book in self.findFiles(cacheIndexDirs, "cache"):
             # print("Book path for "+str(bookI)+": "+str(txtPath))
             if not book:
-                numMissing += 1
-                if numMissing > missingThreshold:
-                    break
-                else:
-                    tempUnlisted.append(bookI)
-                    bookI += 1
-                    continue
-
-            bookPath = book.path
-            if len(tempUnlisted):
-                cacheUnlisted.extend(tempUnlisted)
-                tempUnlisted = []
-            numMissing = 0
+                continue
+            self.cacheBooks.add(bookI)
+        if self.dedupReportPath:
+            self.removeDuplicates(manifest)
+        if self.languageReportPath:
+            self.identifyLanguages()
+        if manifest:
+            manifest.save(self.scanRecords)
+            manifest.close()
+        self.scanRecords = []
+        self.previousScan = {}
+        if self.shard:
+            print("Shard "+str(self.shard[0])+"/"+str(self.shard[1])+": "+str(len(indexDirs))+" book directories and "
+                  +str(len(cacheIndexDirs))+" cache directories scanned, "+str(len(self.books))+" books found")
+            return
+        self.summarizeCorpus()
 
-            newBook = Book(bookI, bookPath)
-            self.cacheBooks[bookI] = newBook
-            bookI += 1
+    # Print the statistics of the loaded books (as in gutenberg.out) and file them by language and format
+    def summarizeCorpus(self):
+        lastIndex = max(self.dirBooks) if self.dirBooks else 0
+        self.unlisted = [bookI for bookI in range(1, lastIndex) if bookI not in self.dirBooks]
+        print("Number of books found in Gutenberg directories: "+str(len(self.dirBooks)))
+        print("Number of book indices skipped: "+str(len(self.unlisted)))
+        lastIndex = max(self.cacheBooks) if self.cacheBooks else 0
+        cacheUnlisted = [bookI for bookI in range(1, lastIndex) if bookI not in self.cacheBooks]
         print("Number of text books found in cache: "+str(len(self.cacheBooks)))
         print("Number of book indices not found as text books in cache: "+str(len(cacheUnlisted)))
         foundStr = "Indices in cache but not in directory structure:\n"
@@ -469,13 +1233,16 @@ class Gutenberg:
                 dirFoundCount += 1
         # dirFoundStr += "\n"
         dirFoundStr += "Total books found only in directory structure: "+str(dirFoundCount)+"\n"
+        self.cacheOnlyBooks = cacheOnlyList
+        self.dirOnlyBooks = dirOnlyList
+        self.notFoundBooks = notFoundList
         print(dirFoundStr)
         print("Books found as epubs but not txt: "+str(len(self.epubs)))
         for bookI in self.epubs:
-            print(self.epubs[bookI])
+            print(self.books[bookI])
         print("\nBooks found as pdfs but not txt: "+str(len(self.pdfs)))
         for bookI in self.pdfs:
-            print(self.pdfs[bookI])
+            print(self.books[bookI])
         print("Total books not found in either cache or directory structure: "+str(notFoundCount)+"\n")
         print(notFoundStr+"\n")
         # Print all files in cache directories of unfound books
@@ -492,10 +1259,8 @@ class Gutenberg:
                 print("No directory files for "+str(bookI))
             print("")
         for index, book in self.books.items():
-            langs = book.languages
-            filename, file_extension = os.path.splitext(book.path)
-            for lang in langs:
-                self.addBookLang(lang, book, file_extension[1:]) # Don't include dot in file extension
+            for lang in book.languages:
+                self.addBookLang(lang, index, book.format)
         print("\n== Languages: ==")
         for lang, formats in self.languages.items():
             totalLang = 0
@@ -508,49 +1273,441 @@ class Gutenberg:
             print(book, end='')
         print("")
 
+    # The corpus statistics loadCorpus prints, as numbers for --report
+    def getStatistics(self):
+        languages = {lang: {fileFormat: len(books) for fileFormat, books in fileFormats.items()}
+                     for lang, fileFormats in self.languages.items()}
+        formats = {}
+        for book in self.books.values():
+            formats[book.format] = formats.get(book.format, 0)+1
+        return {"books": len(self.books), "dirBooks": len(self.dirBooks), "cacheBooks": len(self.cacheBooks),
+                "skippedIndices": len(self.unlisted), "cacheOnlyBooks": len(self.cacheOnlyBooks),
+                "dirOnlyBooks": len(self.dirOnlyBooks), "notFoundBooks": len(self.notFoundBooks),
+                "epubOnlyBooks": len(self.epubs), "pdfOnlyBooks": len(self.pdfs), "noLangBooks": len(self.noLangBooks),
+                "duplicates": len(self.duplicates), "formats": formats, "languages": languages}
+
+    # Write the phase stats and corpus statistics of this run as JSON. info is added at the top level.
+    def writeReport(self, reportPath, info=None):
+        import json
+        import resource
+        report = dict(info or {})
+        report["phases"] = self.stats.asDict()
+        report["statistics"] = self.getStatistics()
+        report["maxRssKB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with open(reportPath, 'w') as reportFile:
+            json.dump(report, reportFile, indent=1, sort_keys=True)
+            reportFile.write("\n")
+
+    # Yield the list file one section header or path line at a time
+    def iterList(self):
+        for lang, fileFormats in self.languages.items():
+            yield "\n LANGUAGE "+lang+":\n"
+            for fileFormat, books in fileFormats.items():
+                yield "\n FILE FORMAT "+fileFormat+":\n"
+                for index in books:
+                    yield self.books[index].path+"\n"
+
     def list(self):
-        listStr = ""
+        return "".join(self.iterList())
+
+    @timedPhase("writeList")
+    def writeList(self, listPath):
+        with open(listPath, 'w', buffering=LIST_BUFFER_SIZE) as listFile:
+            listFile.writelines(self.iterList())
+            self.stats.add("writeList", bytesWritten=listFile.tell(), fsCalls=1)
+
+    # Write the binary index of the loaded books that 'query' reads (see book_index.py)
+    @timedPhase("writeBookIndex")
+    def writeBookIndex(self, indexPath):
+        entries = ((index, lang, fileFormat, self.books[index].path) for lang, fileFormats in self.languages.items()
+                   for fileFormat, books in fileFormats.items() for index in books)
+        numEntries = writeBookIndex(indexPath, entries)
+        self.stats.add("writeBookIndex", bytesWritten=os.path.getsize(indexPath), fsCalls=2)
+        return numEntries
+
+    # Open the book index of the list file self.dir, or self.dir itself if it is an index. An index that
+    # is missing or older than its list file is rebuilt from the list first.
+    def openBookIndex(self):
+        if self.dir.endswith(BOOK_INDEX_EXTENSION):
+            return BookIndex(self.dir)
+        indexPath = getBookIndexPath(self.dir)
+        if not os.path.isfile(indexPath) or self.getMtime(indexPath) < self.getMtime(self.dir):
+            eprint("Building the book index "+indexPath)
+            self.loadList()
+            self.writeBookIndex(indexPath)
+        return BookIndex(indexPath)
+
+    # Write the path of each book in the index with one of the languages and formats and an index from
+    # minIndex to maxIndex to outFile, once per book; None matches anything. Return the number of paths.
+    @timedPhase("queryBooks")
+    def queryBooks(self, outFile, languages=None, formats=None, minIndex=None, maxIndex=None):
+        numPaths = 0
+        with self.openBookIndex() as bookIndex:
+            lastIndex = None
+            indexPaths = set() # A book listed under several languages is written once
+            for index, lang, fileFormat, path in bookIndex.query(languages, formats, minIndex, maxIndex):
+                if index != lastIndex:
+                    lastIndex = index
+                    indexPaths = set()
+                if path not in indexPaths:
+                    indexPaths.add(path)
+                    outFile.write(path+"\n")
+                    numPaths += 1
+        return numPaths
+
+    # Write each txt book in entries (default: the loaded books) to target_path/lang/txt without its
+    # Gutenberg header and footer, as UTF-8. Books are cleaned in a pool of jobs processes. The time
+    # taken by each book and any failure are written to target_path/CLEAN_REPORT_NAME.
+    @timedPhase("cleanFiles")
+    def cleanFiles(self, target_path, entries=None):
+        import clean_books
+        if entries is None:
+            entries = self.iterLanguages()
+        targets = {} # {path: [target paths]}, so a book listed under several languages is cleaned once
+        numSkipped = 0
+        for lang, fileFormat, path in entries:
+            if fileFormat != "txt":
+                numSkipped += 1
+                continue
+            formatPath = os.path.join(target_path, lang, fileFormat)
+            os.makedirs(formatPath, exist_ok=True)
+            bookName = ntpath.basename(path)
+            if isCompressed(bookName):
+                bookName = bookName[:-len(GZIP_EXTENSION)]
+            targets.setdefault(path, []).append(os.path.join(formatPath, bookName))
+        tasks = [(path,)+self.guessBookEncoding(path)+(list(dict.fromkeys(bookTargets)),) # Once per target, if listed twice under a language
+                 for path, bookTargets in targets.items()]
+        if numSkipped:
+            print("Skipped "+str(numSkipped)+" epub and pdf books, which can't be cleaned")
+        print("Cleaning "+str(len(tasks))+" books")
+        numCleaned = 0
+        numFailed = 0
+        bookTimes = []
+        startTime = time.time()
+        with open(os.path.join(target_path, CLEAN_REPORT_NAME), 'w') as reportFile:
+            for path, seconds, numLines, error in clean_books.cleanBooks(tasks, self.jobs):
+                if error:
+                    numFailed += 1
+                    eprint("Couldn't clean "+path+": "+error)
+                else:
+                    numCleaned += 1
+                bookTimes.append((seconds, path))
+                self.stats.add("cleanBook", seconds=seconds, calls=1, fsCalls=2+len(targets[path]))
+                reportFile.write(path+"\t"+str(round(seconds, 4))+"\t"+str(numLines)+"\t"+(error or "ok")+"\n")
+                if (numCleaned+numFailed) % PROGRESS_INTERVAL == 0:
+                    print("Cleaned "+str(numCleaned+numFailed)+" books")
+        seconds = max(time.time()-startTime, 1e-6)
+        print("Cleaned "+str(numCleaned)+" books, failed: "+str(numFailed)+" (see "+os.path.join(target_path, CLEAN_REPORT_NAME)+") in "
+              +str(round(seconds, 1))+" s: "+str(round(len(tasks)/seconds, 1))+" books/s")
+        if bookTimes:
+            print("Slowest books:")
+            for bookSeconds, path in sorted(bookTimes, reverse=True)[:SLOWEST_BOOKS_SHOWN]:
+                print(str(round(bookSeconds, 3))+" s "+path)
+        return numFailed
+
+    # Write the bytes, lines, tokens and characters of the books, and the distribution of their lengths,
+    # per language and format, per format and in total, to reportPath as JSON. entries are (lang, fileFormat,
+    # path) as from iterListFile, and default to the loaded books. A book listed under several languages is
+    # read once and counted in each of them, but only once in its format's and the total's numbers.
+    # With stripHeaders txt books are counted without their Gutenberg headers and footers.
+    @timedPhase("writeCorpusStats")
+    def writeCorpusStats(self, reportPath, entries=None, stripHeaders=False):
+        import json
+        import corpus_stats
+        if entries is None:
+            entries = self.iterLanguages()
+        bookKeys = {} # {path: [(lang, fileFormat)]}
+        formats = {}
+        for lang, fileFormat, path in entries:
+            keys = bookKeys.setdefault(path, [])
+            if (lang, fileFormat) not in keys:
+                keys.append((lang, fileFormat))
+            formats[path] = fileFormat
+        tasks = [(path,)+(self.guessBookEncoding(path) if formats[path] == "txt" else ("", True))+(formats[path], keys+[(None, formats[path]), (None, None)])
+                 for path, keys in bookKeys.items()]
+        print("Counting "+str(len(tasks))+" books")
+        startTime = time.time()
+        aggregates, failures = corpus_stats.computeStats(tasks, jobs=self.jobs, stripHeaders=stripHeaders)
+        seconds = max(time.time()-startTime, 1e-6)
+        total = aggregates.get((None, None), corpus_stats.Aggregate())
+        self.stats.add("countBook", calls=len(tasks), bytesRead=int(total.sums[0]), fsCalls=len(tasks))
+        report = {"stripHeaders": stripHeaders, "total": total.asDict(), "formats": {}, "languages": {}, "failures": failures}
+        for (lang, fileFormat), aggregate in aggregates.items():
+            if lang is not None:
+                report["languages"].setdefault(lang, {})[fileFormat] = aggregate.asDict()
+            elif fileFormat is not None:
+                report["formats"][fileFormat] = aggregate.asDict()
+        with open(reportPath, 'w') as reportFile:
+            json.dump(report, reportFile, indent=1, sort_keys=True)
+            reportFile.write("\n")
+        for path, error in failures:
+            eprint("Couldn't count "+path+": "+error)
+        print("Counted "+str(total.books)+" books, failed: "+str(total.failed)+" in "+str(round(seconds, 1))+" s: "
+              +str(round(len(tasks)/seconds, 1))+" books/s, "+str(round(total.sums[0]/seconds/(1 << 20), 1))+" MB/s")
+        for field, value in zip(corpus_stats.COUNT_FIELDS, total.sums):
+            print("Total "+field+": "+str(int(value)))
+        print("Statistics written to "+reportPath)
+        return len(failures)
+
+    # Yield (lang, fileFormat, path) for the loaded books
+    def iterLanguages(self):
         for lang, fileFormats in self.languages.items():
-            listStr += "\n LANGUAGE "+lang+":\n"
             for fileFormat, books in fileFormats.items():
-                listStr += "\n FILE FORMAT "+fileFormat+":\n"
-                for book in books:
-                    listStr += book.path+"\n"
-        return listStr
-
-    def placeFile(self, command, bookPath, targetPath):
-        bookTarget = ""
-        if "/" in bookPath:
-            bookTarget = os.path.join(targetPath, ntpath.basename(bookPath))
-        else:
-            bookTarget = os.path.join(targetPath, bookTarget)
+                for index in books:
+                    yield lang, fileFormat, self.books[index].path
+
+    # Copy with in-kernel copy_file_range (or sendfile) so file data never passes through Python.
+    # Falls back to a buffered copy where neither is supported. Returns the number of bytes copied.
+    def copyFile(self, sourcePath, targetPath):
+        with open(sourcePath, 'rb') as source, open(targetPath, 'wb') as target:
+            size = os.fstat(source.fileno()).st_size
+            copied = 0
+            numCalls = 3 # open, open, fstat
+            for copyRange in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+                if copyRange is None:
+                    continue
+                try:
+                    while copied < size:
+                        if copyRange is os.sendfile:
+                            sent = os.sendfile(target.fileno(), source.fileno(), copied, size-copied)
+                        else:
+                            sent = os.copy_file_range(source.fileno(), target.fileno(), size-copied, copied, copied)
+                        numCalls += 1
+                        if not sent:
+                            break
+                        copied += sent
+                    break
+                except OSError as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS or copied:
+                        raise
+            source.seek(copied)
+            target.seek(copied)
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+            copied = target.tell()
+        shutil.copymode(sourcePath, targetPath)
+        self.stats.add("placeFile", bytesRead=copied, bytesWritten=copied, fsCalls=numCalls+2) # copymode: stat, chmod
+        return copied
+
+    # A rename when source and target are on the same device; shutil.move (copy + delete) otherwise
+    def moveFile(self, sourcePath, targetPath, targetDevice):
+        sourceStat = os.stat(sourcePath)
+        try:
+            if sourceStat.st_dev == targetDevice:
+                os.rename(sourcePath, targetPath)
+                self.stats.add("placeFile", fsCalls=2)
+                return sourceStat.st_size
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        shutil.move(sourcePath, targetPath)
+        self.stats.add("placeFile", bytesRead=sourceStat.st_size, bytesWritten=sourceStat.st_size, fsCalls=5)
+        return sourceStat.st_size
+
+    # Share the source's data blocks with a FICLONE ioctl (btrfs, XFS, ...). Across devices this
+    # falls back to copyFile. Returns the number of bytes copied, which is 0 for a reflink.
+    def reflinkFile(self, sourcePath, targetPath):
+        import fcntl
+        with open(sourcePath, 'rb') as source, open(targetPath, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                self.stats.add("placeFile", fsCalls=3)
+                return 0
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        return self.copyFile(sourcePath, targetPath)
+
+    # A hard link, or a symlink when source and target are on different devices
+    def linkFile(self, command, sourcePath, targetPath):
+        self.stats.add("placeFile", fsCalls=1)
+        if command == "link":
+            try:
+                os.link(sourcePath, targetPath)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        os.symlink(os.path.abspath(sourcePath), targetPath)
+
+    # copy decompresses gzipped texts unless keepCompressed, so it's the only command that changes the file name
+    def isDecompressed(self, command, bookPath):
+        return command == "copy" and not self.keepCompressed and isCompressed(bookPath)
+
+    def getPlaceTarget(self, bookPath, targetPath, command=""):
+        bookName = ntpath.basename(bookPath)
+        if self.isDecompressed(command, bookPath):
+            bookName = bookName[:-len(GZIP_EXTENSION)]
+        return os.path.join(targetPath, bookName)
+
+    # Stream a txt file out of its zip archive, or decompress a gzipped one. Any command extracts a
+    # copy of an archive member, since it can't be moved or linked on its own. Returns the number of
+    # bytes written, or None if the book is corrupt (nothing is left at targetPath then).
+    def extractFile(self, bookPath, targetPath):
+        try:
+            with openBookFile(bookPath) as source, open(targetPath, 'wb') as target:
+                shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+                self.stats.add("placeFile", bytesRead=target.tell(), bytesWritten=target.tell(), fsCalls=2)
+                return target.tell()
+        except getBookReadErrors() as e:
+            if os.path.isfile(targetPath): # Don't leave a partial book behind
+                os.unlink(targetPath)
+            if isinstance(e, OSError): # Missing files and full disks still stop the run
+                raise
+            eprint("Couldn't extract "+bookPath+": "+(str(e) or type(e).__name__))
+            return None
+
+    # Remove whatever an earlier run left at targetPath, so a copy never writes through a hard link or
+    # symlink into the mirror. Raises shutil.SameFileError if targetPath is sourcePath itself.
+    def clearPlaceTarget(self, sourcePath, targetPath):
+        if not os.path.lexists(targetPath):
+            return
+        targetDir, targetName = os.path.split(targetPath)
+        if os.path.join(os.path.realpath(targetDir), targetName) == os.path.realpath(sourcePath):
+            raise shutil.SameFileError(sourcePath+" and "+targetPath+" are the same file")
+        os.unlink(targetPath) # Another name for the file at most, so the source keeps its data
+        self.stats.add("placeFile", fsCalls=2)
+
+    @timedPhase("placeFile")
+    def placeFile(self, command, bookPath, targetPath, targetDevice=None):
+        bookTarget = self.getPlaceTarget(bookPath, targetPath, command)
+        if command == "move" and not isArchiveMember(bookPath) and not os.path.lexists(bookPath) and os.path.lexists(bookTarget):
+            return 0 # Moved by a run that stopped before journaling it; the target is the only copy now
+        self.clearPlaceTarget(bookPath, bookTarget)
+        if isArchiveMember(bookPath) or self.isDecompressed(command, bookPath):
+            return self.extractFile(bookPath, bookTarget)
         if command == "move":
-            shutil.move(bookPath, bookTarget)
+            if targetDevice is None:
+                targetDevice = os.stat(targetPath).st_dev
+            return self.moveFile(bookPath, bookTarget, targetDevice)
         elif command == "copy":
-            shutil.copy(bookPath, bookTarget)
+            return self.copyFile(bookPath, bookTarget)
+        elif command == "reflink":
+            return self.reflinkFile(bookPath, bookTarget)
+        elif command in LINK_COMMANDS:
+            self.linkFile(command, bookPath, bookTarget)
+        return 0
+
+    # Try command once with a scratch file in targetPath, so a target filesystem without
+    # link/symlink/reflink support fails before anything is placed
+    def checkPlaceSupport(self, command, bookPath, targetPath):
+        if command not in LINK_COMMANDS and command != "reflink" or isArchiveMember(bookPath): # Archive members are extracted
+            return True
+        testPath = os.path.join(targetPath, PLACE_TEST_NAME)
+        try:
+            if os.path.lexists(testPath):
+                os.unlink(testPath)
+            if command == "reflink":
+                self.reflinkFile(bookPath, testPath)
+            else:
+                self.linkFile(command, bookPath, testPath)
+        except OSError as e:
+            eprint("The target directory "+targetPath+" doesn't support '"+command+"': "+str(e))
+            return False
+        finally:
+            if os.path.lexists(testPath):
+                os.unlink(testPath)
+        return True
+
+    # placeFile, then record the placement in the journal. A book listed under several languages
+    # can only be moved once, so later moves of it copy the file from where it was moved to.
+    def placeJournaledFile(self, journal, command, bookPath, targetPath, targetDevice):
+        movedTo = journal.movedTo.get(bookPath) if command == "move" else None
+        if movedTo and not os.path.lexists(bookPath):
+            bookTarget = self.getPlaceTarget(bookPath, targetPath, command)
+            if os.path.abspath(bookTarget) == movedTo: # Listed twice in the same language and format
+                return 0
+            self.clearPlaceTarget(movedTo, bookTarget)
+            numBytes = self.copyFile(movedTo, bookTarget)
+        else:
+            numBytes = self.placeFile(command, bookPath, targetPath, targetDevice)
+        if numBytes is None: # Corrupt, so not recorded; a rerun tries it again
+            return 0
+        journal.record(command, bookPath, self.getPlaceTarget(bookPath, targetPath, command))
+        return numBytes
 
-    def organizeFiles(self, command, target_path):
+    # Place each (lang, fileFormat, path) in target_path/lang/fileFormat. entries defaults to the
+    # loaded books; pass iterListFile to start placing files while a list file is still being read.
+    # With jobs > 1, up to jobs files are placed at once. Placements recorded in the target's
+    # journal by an earlier run are skipped; with verify, only if the target's size and mtime
+    # still match the journal.
+    @timedPhase("organizeFiles")
+    def organizeFiles(self, command, target_path, entries=None, verify=False):
+        if entries is None:
+            entries = self.iterLanguages()
+            formatKeys = [(lang, fileFormat) for lang, fileFormats in self.languages.items() for fileFormat in fileFormats]
+        else:
+            formatKeys = []
         if not os.path.exists(target_path):
             os.makedirs(target_path)
-        for lang, fileFormats in self.languages.items():
-            langPath = os.path.join(target_path, lang)
-            if not os.path.exists(langPath):
-                os.makedirs(langPath)
-            for fileFormat, books in fileFormats.items():
-                formatPath = os.path.join(langPath, fileFormat)
-                if not os.path.exists(formatPath):
-                    os.makedirs(formatPath)
-                for book in books:
-                    self.placeFile(command, book.path, formatPath)
+        targetDevice = os.stat(target_path).st_dev
+        journal = OrganizeJournal(os.path.join(target_path, JOURNAL_NAME))
+        numSkipped = 0
+        movedPaths = set()
+        formatPaths = {}
+        for lang, fileFormat in formatKeys: # Known up front when the books are loaded
+            formatPaths[(lang, fileFormat)] = os.path.join(target_path, lang, fileFormat)
+            os.makedirs(formatPaths[(lang, fileFormat)], exist_ok=True)
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        executor = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        pending = set()
+        numFiles = 0
+        numBytes = 0
+        startTime = time.time()
+        try:
+            for lang, fileFormat, path in entries:
+                formatPath = formatPaths.get((lang, fileFormat))
+                if formatPath is None:
+                    formatPath = os.path.join(target_path, lang, fileFormat)
+                    os.makedirs(formatPath, exist_ok=True)
+                    formatPaths[(lang, fileFormat)] = formatPath
+                if journal.isPlaced(command, path, self.getPlaceTarget(path, formatPath, command), verify):
+                    numSkipped += 1
+                    continue
+                if not numFiles and not self.checkPlaceSupport(command, path, formatPath):
+                    return False
+                if executor:
+                    if command == "move" and path in movedPaths: # Let the first move finish before copying it
+                        for future in pending:
+                            numBytes += future.result()
+                        pending = set()
+                    if len(pending) >= self.jobs*4: # Bound the queue so a huge list isn't submitted at once
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            numBytes += future.result()
+                    if command == "move":
+                        movedPaths.add(path)
+                    pending.add(executor.submit(self.placeJournaledFile, journal, command, path, formatPath, targetDevice))
+                else:
+                    numBytes += self.placeJournaledFile(journal, command, path, formatPath, targetDevice)
+                numFiles += 1
+                if numFiles % PROGRESS_INTERVAL == 0:
+                    print("Placed "+str(numFiles)+" files")
+            for future in pending:
+                numBytes += future.result()
+        finally:
+            if executor:
+                executor.shutdown()
+            journal.close()
+        if numSkipped:
+            print("Skipped "+str(numSkipped)+" files already placed by an earlier run (see "+journal.path+")")
+        seconds = max(time.time()-startTime, 1e-6)
+        print("Placed "+str(numFiles)+" files ("+str(round(numBytes/1e6, 1))+" MB) in "+str(round(seconds, 1))+" s: "
+              +str(round(numBytes/1e6/seconds, 1))+" MB/s, "+str(round(numFiles/seconds, 1))+" files/s")
+        return True
 
 
 class Book:
-    def __init__(self, index=-1, path="", languages=["en"], title=""):
+    __slots__ = ("index", "path", "format", "languages", "title", "author", "subjects", "encoding")
+
+    def __init__(self, index=-1, path="", languages=("en",), title="", author="", subjects=(), fileFormat="", encoding=""):
         self.index = index
+        self.path = path
+        self.format = fileFormat
         self.languages = languages
-        self.filetypes = []
         self.title = title
-        self.path = path
+        self.author = author
+        self.subjects = subjects
+        self.encoding = encoding # Python codec name of a txt book, or "" if not known yet
 
     def __str__(self):
         return "Book index: "+str(self.index)+" path: "+str(self.path)
@@ -566,13 +1723,164 @@ class Language:
         self.dirBooks.append(book)
 
 
-gutenberg = Gutenberg(args.gutenberg_dir)
-gutenberg.loadCorpus()
+# Return (shardI, numShards) for --shard K/N, or None if not sharding
+def parseShard(shard):
+    if not shard:
+        return None
+    try:
+        shardI, numShards = (int(part) for part in shard.split("/"))
+    except ValueError:
+        shardI, numShards = -1, 0
+    if not 0 <= shardI < numShards:
+        eprint("--shard needs to be K/N with K from 0 to N-1: "+shard)
+        sys.exit(1)
+    return shardI, numShards
+
+
+def getShardPath(listPath, shardI, numShards):
+    return listPath+SHARD_SUFFIX.format(shardI, numShards)
+
+
+# Return the paths of the partial results of the 'list --shard' runs for listPath, in shard order.
+# Print what's missing and return None unless there is exactly one result for each of the N shards.
+def findShardPaths(listPath):
+    import glob
+    shardPaths = {}
+    for path in glob.glob(glob.escape(listPath)+SHARD_SUFFIX.format("*", "*")):
+        match = SHARD_REGEX.search(path)
+        if match and path[:match.start()] == listPath:
+            shardPaths[(int(match.group(2)), int(match.group(1)))] = path
+    numShards = {key[0] for key in shardPaths}
+    if len(numShards) != 1:
+        if numShards:
+            eprint("Partial results of different numbers of shards ("+", ".join(str(n) for n in sorted(numShards))+") found for "+listPath)
+        else:
+            eprint("No partial results of 'list --shard' found for "+listPath)
+        return None
+    numShards = numShards.pop()
+    missing = [shardI for shardI in range(numShards) if (numShards, shardI) not in shardPaths]
+    if missing:
+        eprint("Missing the partial results of shards "+", ".join(str(shardI) for shardI in missing)+" of "+str(numShards)+" for "+listPath)
+        return None
+    return [shardPaths[(numShards, shardI)] for shardI in range(numShards)]
+
+
+# Return (minIndex, maxIndex) for --indices: "13083", "100-200", "100-" or "-200"; None where unbounded
+def parseIndexRange(indices):
+    if not indices:
+        return None, None
+    try:
+        if "-" not in indices:
+            return int(indices), int(indices)
+        first, last = indices.split("-")
+        return (int(first) if first else None), (int(last) if last else None)
+    except ValueError:
+        eprint("--indices needs to be an index or a range such as 100-200: "+indices)
+        sys.exit(1)
+
+
+# Run the chosen command on gutenberg; return False if it failed
+def runCommand(gutenberg, args):
+    if args.catalog and args.command == 'list':
+        gutenberg.loadCatalog(args.catalog)
+    if args.command == 'list':
+        gutenberg.loadCorpus()
+        if gutenberg.shard: # The shard's manifest is its partial result
+            print("Partial result written to "+gutenberg.manifestPath)
+            return True
+        gutenberg.writeList(args.target_path)
+        gutenberg.writeBookIndex(getBookIndexPath(args.target_path))
+    elif args.command == 'merge':
+        shardPaths = findShardPaths(args.target_path)
+        if not shardPaths:
+            return False
+        gutenberg.mergeShards(shardPaths)
+        gutenberg.writeList(args.target_path)
+        gutenberg.writeBookIndex(getBookIndexPath(args.target_path))
+    elif args.command in PLACE_COMMANDS:
+        if os.path.isfile(args.gutenberg_dir):
+            return gutenberg.organizeFiles(args.command, args.target_path, gutenberg.iterListFile(args.gutenberg_dir), verify=args.verify)
+        gutenberg.loadCorpus()
+        return gutenberg.organizeFiles(args.command, args.target_path, verify=args.verify)
+    elif args.command == 'clean':
+        if os.path.isfile(args.gutenberg_dir):
+            gutenberg.cleanFiles(args.target_path, gutenberg.iterListFile(args.gutenberg_dir))
+        else:
+            gutenberg.loadCorpus()
+            gutenberg.cleanFiles(args.target_path)
+    elif args.command == 'dedup-near':
+        if os.path.isfile(args.gutenberg_dir):
+            gutenberg.findNearDuplicates(args.target_path, gutenberg.iterListFile(args.gutenberg_dir), threshold=args.threshold)
+        else:
+            gutenberg.loadCorpus()
+            gutenberg.findNearDuplicates(args.target_path, threshold=args.threshold)
+    elif args.command == 'query':
+        minIndex, maxIndex = parseIndexRange(args.indices)
+        languages = args.language.split(",") if args.language else None
+        formats = args.format.split(",") if args.format else None
+        if args.target_path:
+            with open(args.target_path, 'w') as queryFile:
+                gutenberg.queryBooks(queryFile, languages, formats, minIndex, maxIndex)
+        else:
+            try:
+                gutenberg.queryBooks(sys.stdout, languages, formats, minIndex, maxIndex)
+                sys.stdout.flush()
+            except BrokenPipeError: # The reader stopped early, as in 'query ... | head'
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno()) # So flushing at exit doesn't fail again
+                sys.exit(1)
+    elif args.command == 'stats':
+        if os.path.isfile(args.gutenberg_dir) and args.gutenberg_dir.endswith(".sqlite"): # A scan manifest
+            gutenberg.loadScan(args.gutenberg_dir)
+            return gutenberg.writeCorpusStats(args.target_path, stripHeaders=args.strip_headers) == 0
+        if os.path.isfile(args.gutenberg_dir):
+            return gutenberg.writeCorpusStats(args.target_path, gutenberg.iterListFile(args.gutenberg_dir), stripHeaders=args.strip_headers) == 0
+        gutenberg.loadCorpus()
+        return gutenberg.writeCorpusStats(args.target_path, stripHeaders=args.strip_headers) == 0
+    return True
+
+
+# Run the command line. Importing this module only defines Gutenberg, Book and the helpers; nothing is
+# scanned or loaded until a method asks for it.
+def main(argv=None):
+    args = argParser.parse_intermixed_args(argv) # Lets the optional target_path of query come after the options
+    if not checkArgs(args):
+        sys.exit(1)
+    shard = parseShard(args.shard)
+    manifestPath = None
+    if shard:
+        manifestPath = getShardPath(args.target_path, *shard)
+    elif args.command in SCAN_COMMANDS:
+        manifestPath = os.path.join(os.path.dirname(os.path.abspath(args.target_path)), MANIFEST_NAME)
+    dedupReportPath = None
+    if args.dedup and args.command in SCAN_COMMANDS:
+        dedupReportPath = args.target_path+".duplicates"
+    languageReportPath = None
+    if args.identify_languages and args.command in SCAN_COMMANDS:
+        languageReportPath = args.target_path+".languages"
+    gutenberg = Gutenberg(args.gutenberg_dir, jobs=args.jobs, manifestPath=manifestPath, incremental=args.incremental,
+                          dedupReportPath=dedupReportPath, keepCompressed=args.keep_compressed,
+                          stats=PhaseStats() if args.report else None, shard=shard, languageReportPath=languageReportPath)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    startTime = time.time()
+    try:
+        succeeded = runCommand(gutenberg, args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            eprint("Profile written to "+args.profile)
+    if args.report:
+        gutenberg.writeReport(args.report, {"command": args.command, "gutenberg_dir": args.gutenberg_dir, "target_path": args.target_path,
+                                            "jobs": args.jobs, "incremental": args.incremental, "startTime": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(startTime)),
+                                            "seconds": round(time.time()-startTime, 6)})
+        eprint("Report written to "+args.report)
+    if not succeeded:
+        sys.exit(1)
 
-if args.command == 'list':
-    outStr = gutenberg.list()
 
-    targetFile = open(args.target_path, 'w')
-    targetFile.write(outStr)
-elif args.command == 'move' or args.command == 'copy':
-    gutenberg.organizeFiles(args.command, args.target_path)
+if __name__ == '__main__':
+    main()
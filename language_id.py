@@ -0,0 +1,116 @@
+import re
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from book_files import getBookReadErrors, openBookFile
+from cleanup import iter_strip_headers
+
+# Identifies the language of texts from their character trigrams, with a naive Bayes model trained on
+# books whose language is already known. Each text is sampled once: a bounded slice of its lines after
+# the Gutenberg header is stripped, lowercased, with everything but letters turned into spaces. The
+# trigrams of a batch of samples are hashed into buckets and counted with one bincount, and the batch is
+# scored against every language with one matrix product.
+# Used by the --identify-languages option of gutenberg_file_finder.py.
+
+NUM_BUCKETS = 1 << 14 # Trigram hash buckets; collisions cost little accuracy at this size
+SAMPLE_CHARS = 4000 # Characters of text sampled per book, after skipping SAMPLE_SKIP_LINES lines
+SAMPLE_SKIP_LINES = 40 # Title pages and tables of contents often follow the header
+BATCH_SIZE = 256 # Samples counted and scored at once; bounds memory to BATCH_SIZE*NUM_BUCKETS*4 bytes
+MIN_TRAINING_BOOKS = 3 # Languages with fewer labeled books aren't identified
+MAX_TRAINING_BOOKS = 200 # Labeled books used per language
+MIN_MARGIN = 0.2 # Margin (see LanguageIdentifier.identify) below which an identification isn't trusted
+SMOOTHING = 0.5 # Added to every trigram count of a language
+TRIGRAM_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+NON_LETTER_REGEX = re.compile(r"[\W\d_]+")
+
+
+# Worker: return the normalized sample of a text, or "" if it can't be read
+def readSample(task):
+    path, encoding = task
+    try:
+        with openBookFile(path) as textFile:
+            lines = islice(iter_strip_headers(textFile, encoding), SAMPLE_SKIP_LINES, None)
+            sample = []
+            numChars = 0
+            for line in lines:
+                if numChars >= SAMPLE_CHARS:
+                    break
+                sample.append(line)
+                numChars += len(line)+1
+    except getBookReadErrors()+(LookupError, ValueError):
+        return ""
+    sample = NON_LETTER_REGEX.sub(" ", " ".join(sample).lower())
+    return " "+" ".join(sample.split())[:SAMPLE_CHARS]+" "
+
+
+# Yield the sample of each (path, encoding) task, in order, read in a pool of jobs processes
+def readSamples(tasks, jobs=1):
+    if jobs > 1:
+        chunksize = max(1, min(64, len(tasks)//(jobs*8)))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for sample in executor.map(readSample, tasks, chunksize=chunksize):
+                yield sample
+    else:
+        for task in tasks:
+            yield readSample(task)
+
+
+# Return a (len(samples), NUM_BUCKETS) float32 matrix of the hashed trigram counts of each sample
+def getTrigramCounts(samples):
+    codes = np.frombuffer("".join(samples).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    lengths = np.fromiter((len(sample) for sample in samples), dtype=np.int64, count=len(samples))
+    rows = np.repeat(np.arange(len(samples), dtype=np.int64), lengths)
+    inSample = rows[:-2] == rows[2:] # Trigrams that don't run into the next sample
+    hashes = ((codes[:-2] << np.uint64(42)) ^ (codes[1:-1] << np.uint64(21)) ^ codes[2:])*TRIGRAM_MULTIPLIER
+    buckets = (hashes >> np.uint64(64-NUM_BUCKETS.bit_length()+1)).astype(np.int64)
+    cells = rows[:-2][inSample]*NUM_BUCKETS+buckets[inSample]
+    counts = np.bincount(cells, minlength=len(samples)*NUM_BUCKETS)
+    return counts.reshape(len(samples), NUM_BUCKETS).astype(np.float32)
+
+
+class LanguageIdentifier:
+    def __init__(self):
+        self.languages = []
+        self.logProbs = None # (len(languages), NUM_BUCKETS) log probability of each trigram bucket
+
+    # Learn the trigram profile of each language from samples labeled with one language each
+    def train(self, samples, labels):
+        totals = {}
+        numBooks = {}
+        for start in range(0, len(samples), BATCH_SIZE):
+            counts = getTrigramCounts(samples[start:start+BATCH_SIZE])
+            for label, row in zip(labels[start:start+BATCH_SIZE], counts):
+                if label not in totals:
+                    totals[label] = np.zeros(NUM_BUCKETS, dtype=np.float64)
+                    numBooks[label] = 0
+                totals[label] += row
+                numBooks[label] += 1
+        self.languages = sorted(label for label in totals if numBooks[label] >= MIN_TRAINING_BOOKS)
+        if not self.languages:
+            self.logProbs = None
+            return
+        profiles = np.vstack([totals[lang] for lang in self.languages])+SMOOTHING
+        self.logProbs = np.log(profiles/profiles.sum(axis=1, keepdims=True)).astype(np.float32)
+
+    # Return (language, margin) for each sample: the most likely language and how much more likely it is
+    # than the next one, as the mean log probability difference per trigram. ("", 0.0) for an empty sample.
+    def identify(self, samples):
+        results = []
+        for start in range(0, len(samples), BATCH_SIZE):
+            counts = getTrigramCounts(samples[start:start+BATCH_SIZE])
+            numTrigrams = counts.sum(axis=1)
+            if self.logProbs is None:
+                results += [("", 0.0)]*len(counts)
+                continue
+            scores = counts @ self.logProbs.T
+            best = scores.argmax(axis=1)
+            if len(self.languages) > 1:
+                topTwo = np.partition(scores, -2, axis=1)[:, -2:]
+                margins = (topTwo[:, 1]-topTwo[:, 0])/np.maximum(numTrigrams, 1)
+            else:
+                margins = np.zeros(len(counts), dtype=np.float32)
+            for lang, margin, trigrams in zip(best, margins, numTrigrams):
+                results.append((self.languages[lang], float(margin)) if trigrams else ("", 0.0))
+        return results
@@ -0,0 +1,157 @@
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from book_files import getBookReadErrors, openBookFile, sniffTextEncoding
+from cleanup import iter_strip_headers
+
+# Finds near-duplicate texts (re-releases, transcodings, revised editions) with MinHash
+# signatures over word shingles and locality-sensitive hashing of signature bands.
+# Used by the 'dedup-near' command of gutenberg_file_finder.py.
+
+NUM_PERMUTATIONS = 128
+BAND_THRESHOLD_SHARE = 0.8 # Bands are laid out so pairs this share of the threshold have even odds of sharing a bucket
+SHINGLE_SIZE = 5 # Words per shingle
+SHINGLE_MULTIPLIER = np.uint64(1000003)
+MAX_BUCKET_COMPARISONS = 256 # Earlier members of a bucket each member is compared with; bounds huge buckets
+SIGNATURE_CHUNK = 8192 # Shingles hashed at once; bounds memory to NUM_PERMUTATIONS*SIGNATURE_CHUNK*8 bytes
+PERMUTATION_SEED = 13083
+WORD_REGEX = re.compile(r"\w+")
+
+_permutations = None
+
+
+# The same random hash functions in every worker process
+def getPermutations():
+    global _permutations
+    if _permutations is None:
+        rng = np.random.default_rng(PERMUTATION_SEED)
+        multipliers = rng.integers(1, 2**63, size=NUM_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+        offsets = rng.integers(0, 2**63, size=NUM_PERMUTATIONS, dtype=np.uint64)
+        _permutations = (multipliers[:, None], offsets[:, None])
+    return _permutations
+
+
+# The text without its Gutenberg header and footer, cleaned as it is read
+def readCleanText(path, encoding):
+    with openBookFile(path) as textFile:
+        return "\n".join(iter_strip_headers(textFile, encoding))
+
+
+# Return the sorted unique 64-bit hashes of the text's lowercased word shingles
+def getShingles(text):
+    words = WORD_REGEX.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    wordHashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64, count=len(words))
+    numShingles = max(len(words)-SHINGLE_SIZE+1, 1)
+    shingles = np.zeros(numShingles, dtype=np.uint64)
+    for offset in range(min(SHINGLE_SIZE, len(words))):
+        shingles = shingles*SHINGLE_MULTIPLIER+wordHashes[offset:offset+numShingles] # Wraps around at 2^64
+    return np.unique(shingles)
+
+
+def getSignature(shingles):
+    multipliers, offsets = getPermutations()
+    signature = np.full(NUM_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(shingles), SIGNATURE_CHUNK):
+        hashed = multipliers*shingles[None, start:start+SIGNATURE_CHUNK]+offsets
+        hashed ^= hashed >> np.uint64(29)
+        np.minimum(signature, hashed.min(axis=1), out=signature)
+    return signature
+
+
+# Worker: return (path, signature or None, error message). An encoding that isn't confirmed is only the
+# guess from the file's name, and is confirmed from the text's first bytes first.
+def computeSignature(path, encoding, confirmed=True):
+    if not confirmed:
+        encoding = sniffTextEncoding(path, encoding)[0]
+    try:
+        shingles = getShingles(readCleanText(path, encoding))
+    except getBookReadErrors()+(LookupError,) as e:
+        return path, None, str(e) or type(e).__name__
+    if not len(shingles):
+        return path, None, "no words"
+    return path, getSignature(shingles), ""
+
+
+# Return (bands, rows) for locality-sensitive hashing at threshold. Pairs of similarity s share a bucket in
+# at least one band with probability 1-(1-s^rows)^bands, which rises steepest around (1/bands)^(1/rows);
+# the layout whose point is nearest BAND_THRESHOLD_SHARE*threshold is chosen. Pairs right at the threshold
+# are then compared with probability 0.99 at 0.8 (18 bands of 7 rows), 0.87 at 0.5 (32 of 4) and 0.68 at 0.3
+# (42 of 3); more similar pairs more often.
+def getBandLayout(threshold):
+    target = BAND_THRESHOLD_SHARE*threshold
+    layouts = [(NUM_PERMUTATIONS//rows, rows) for rows in range(1, NUM_PERMUTATIONS+1)]
+    return min(layouts, key=lambda layout: abs((1.0/layout[0])**(1.0/layout[1])-target))
+
+
+def getSimilarity(signatures, i, j):
+    return float(np.mean(signatures[i] == signatures[j]))
+
+
+# Return clusters of near-duplicate paths as lists of (path, similarity to the cluster's first path),
+# largest cluster first. encodings are the codec of each path (as recorded on Book), defaulting to UTF-8;
+# confirmed says for each whether it's known or only guessed (see computeSignature), defaulting to known.
+# Signatures are computed in a pool of jobs processes.
+def findNearDuplicates(paths, encodings=None, jobs=1, threshold=0.8, confirmed=None):
+    if encodings is None:
+        encodings = ["utf-8"]*len(paths)
+    if confirmed is None:
+        confirmed = [True]*len(paths)
+    chunksize = max(1, min(64, len(paths)//(jobs*8) if jobs else 1))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(computeSignature, paths, encodings, confirmed, chunksize=chunksize))
+    else:
+        results = [computeSignature(*task) for task in zip(paths, encodings, confirmed)]
+    signedPaths = []
+    signatures = []
+    for path, signature, error in results:
+        if signature is None:
+            print("Skipped "+path+": "+error)
+            continue
+        signedPaths.append(path)
+        signatures.append(signature)
+    if not signatures:
+        return []
+    signatures = np.vstack(signatures)
+
+    parents = list(range(len(signedPaths)))
+
+    def findRoot(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    numBands, rows = getBandLayout(threshold)
+    for band in range(numBands):
+        bandKeys = np.zeros(len(signedPaths), dtype=np.uint64)
+        for row in range(band*rows, (band+1)*rows): # Fold the band's rows into one bucket key
+            bandKeys = bandKeys*SHINGLE_MULTIPLIER+signatures[:, row]
+        order = np.argsort(bandKeys, kind="stable")
+        sortedKeys = bandKeys[order]
+        bucketStarts = np.flatnonzero(np.concatenate(([True], sortedKeys[1:] != sortedKeys[:-1], [True])))
+        sharedBuckets = np.flatnonzero(np.diff(bucketStarts) > 1)
+        for bucket in sharedBuckets:
+            members = order[bucketStarts[bucket]:bucketStarts[bucket+1]]
+            for memberI in range(1, len(members)): # Every pair, so B~C is found in a bucket A happens to share
+                earlier = members[max(0, memberI-MAX_BUCKET_COMPARISONS):memberI]
+                similarities = (signatures[earlier] == signatures[members[memberI]]).mean(axis=1)
+                for other in earlier[similarities >= threshold]:
+                    parents[findRoot(members[memberI])] = findRoot(other)
+
+    clusters = {}
+    for i in range(len(signedPaths)):
+        clusters.setdefault(findRoot(i), []).append(i)
+    result = []
+    for members in clusters.values():
+        if len(members) < 2:
+            continue
+        first = members[0]
+        result.append([(signedPaths[i], getSimilarity(signatures, first, i)) for i in members])
+    result.sort(key=lambda cluster: -len(cluster))
+    return result